@@ -1,3 +1,12 @@
 MAX_EMBEDDING_LENGTH = 8192
 
-__all__ = ['MAX_EMBEDDING_LENGTH']
\ No newline at end of file
+# Startup time budgets (seconds); exceeding them is logged as a warning
+IMPORT_TIME_BUDGET_S = 1.5
+STARTUP_TIME_BUDGET_S = 5.0
+# Default deadline (seconds) for answering one cell, overridable with the X-Request-Timeout header
+ANSWER_DEADLINE_S = 60.0
+
+# Conservative estimate used to check whether a row's stored text fits the token budget
+FAST_PATH_CHARS_PER_TOKEN = 3
+
+__all__ = ['MAX_EMBEDDING_LENGTH', 'FAST_PATH_CHARS_PER_TOKEN', 'ANSWER_DEADLINE_S', 'IMPORT_TIME_BUDGET_S', 'STARTUP_TIME_BUDGET_S']
\ No newline at end of file
@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
@@ -11,11 +11,46 @@ DATABASE_URL = os.getenv("POSTGRESQL_URL")
 if not DATABASE_URL:
     raise ValueError("Environment variable 'POSTGRESQL_URL' is not set")
 
-# Create SQLAlchemy engine
-engine = create_engine(DATABASE_URL)
+# Create SQLAlchemy engine (connections are only opened on first use)
+engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 
 # Create session local class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Base class for declarative models
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+# Columns and indexes added to tables that existed before them; create_all only creates missing tables
+SCHEMA_UPGRADES = [
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS file_mtime DOUBLE PRECISION",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS file_size BIGINT",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash CHAR(64)",
+    "ALTER TABLE cells ADD COLUMN IF NOT EXISTS stale BOOLEAN NOT NULL DEFAULT false",
+    "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS content_hash CHAR(64)",
+    "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS embedding BYTEA",
+    "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS embedding_dtype TEXT",
+    "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS embedding_scale DOUBLE PRECISION",
+    "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS minhash BYTEA",
+    "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS duplicate_of UUID REFERENCES chunks(id) ON DELETE SET NULL",
+    "CREATE INDEX IF NOT EXISTS ix_chunks_text_fts ON chunks USING gin (to_tsvector('english', text))",
+]
+
+def init_db():
+    """
+    Create database tables and add columns and indexes missing from existing ones. Called
+    from the app lifespan (or once by the production entry point) instead of
+    at import time.
+    """
+    import models  # noqa: F401  registers the tables on Base.metadata
+    Base.metadata.create_all(bind=engine)
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            for statement in SCHEMA_UPGRADES:
+                conn.execute(text(statement))
+
+def warm_up_db():
+    """
+    Open a pooled connection so the first request does not pay for the connect.
+    """
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
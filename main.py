@@ -1,22 +1,36 @@
-from typing import List
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+import argparse
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
 from uuid import UUID
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 import logging
 from sqlalchemy.orm import Session
 from fastapi import Depends
 
 # SQLAlchemy setup
-from utils.rag_pipeline import rag_pipeline
-from utils.pinecone_util import upsert_documents, create_pinecone_documents
-from database import engine, Base
-from utils.database_util import save_document_chunks, get_db, save_cell
+from utils.rag_pipeline import rag_pipeline, retrieval_stats
+from utils.pinecone_util import get_index
+from database import init_db, warm_up_db
+from utils.database_util import get_db, save_cell
+from utils.ingestion import ingest_document, reindex_document
+from utils.export import stream_grid_export, EXPORT_MEDIA_TYPES
 from models import Column as ColumnModel, Row as RowModel, Document as DocumentModel, row_documents
-from utils.text import get_text_from_file, RecursiveTokenChunker
+from utils.text import RecursiveTokenChunker, hash_text
+from utils.singleflight import SingleFlight
+from utils.deadline import Deadline, DeadlineExceeded, hedging_stats
+from utils import profiling
 from utils.embedding import VoyageEmbeddings
-from utils.llm import get_answer
+from utils.llm import get_answer, get_client as get_llm_client
+from constants import IMPORT_TIME_BUDGET_S, STARTUP_TIME_BUDGET_S, ANSWER_DEADLINE_S
 
 load_dotenv()
 
@@ -24,13 +38,45 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+import_time = time.perf_counter() - _IMPORT_STARTED
+logger.info(f"main imported in {import_time:.3f}s")
+if import_time > IMPORT_TIME_BUDGET_S:
+    logger.warning(f"Import time {import_time:.3f}s exceeds budget of {IMPORT_TIME_BUDGET_S}s")
 
-app = FastAPI()
 embedding_model = VoyageEmbeddings()
 chunker = RecursiveTokenChunker()
 
+# in-flight deduplication of uploads (by file_ref) and cells (by row, column, fingerprint)
+upload_flight = SingleFlight("upload")
+answer_flight = SingleFlight("answer")
+
+def warm_up():
+    """
+    Create the provider clients and open a database connection up front, so
+    the first request of every worker does not pay for it.
+    """
+    warm_up_db()
+    embedding_model.client
+    get_index()
+    get_llm_client()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    # The production entry point creates the tables once before spawning workers
+    if os.getenv("SKIP_DB_INIT") != "1":
+        init_db()
+    if os.getenv("WARM_UP", "1") == "1":
+        warm_up()
+    startup_time = time.perf_counter() - started
+    logger.info(f"Startup finished in {startup_time:.3f}s")
+    if startup_time > STARTUP_TIME_BUDGET_S:
+        logger.warning(f"Startup time {startup_time:.3f}s exceeds budget of {STARTUP_TIME_BUDGET_S}s")
+    yield
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(profiling.ProfilingMiddleware)
+
 @app.get("/")
 def read_root():
     logger.info("Hello, World!")
@@ -46,28 +92,11 @@ class UploadDocumentResponse(BaseModel):
 @app.post("/upload-document", response_model=UploadDocumentResponse)
 async def upload_document(request: UploadDocumentRequest, db: Session = Depends(get_db)):
     try:
-        # Check if document with this file_ref already exists
-        existing_document = db.query(DocumentModel).filter(DocumentModel.file_ref == request.file_ref).first()
-        if existing_document:
-            return {"message": "Document already uploaded", "document_id": existing_document.id}
-
-        text = get_text_from_file(request.file_ref)
-        logger.info(f"got text {text[:100]}")
-        chunks = chunker.split_text(text)
-        logger.info(f"got chunks {len(chunks)}")
-        embeddings = embedding_model.get_embeddings(chunks, input_type="document")
-        logger.info(f"got embeddings {len(embeddings)}")   
-
-        # save the chunks to the database
-        document_id = save_document_chunks(request.file_ref, chunks)
-
-        # create pinecone documents
-        pinecone_documents = create_pinecone_documents(chunks, embeddings, str(document_id))
-
-        # upsert the embedding to pinecone
-        upsert_documents(pinecone_documents)
-
-        return {"message": "Document uploaded successfully", "document_id": document_id}
+        message, document_id = await upload_flight.do(
+            request.file_ref,
+            lambda: profiling.to_thread(ingest_document, db, request.file_ref, chunker, embedding_model)
+        )
+        return {"message": message, "document_id": document_id}
     except Exception as e:
         logger.error(f"Error uploading document: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -162,8 +191,27 @@ class AnswerResponseItem(BaseModel):
 class AnswerResponse(BaseModel):
     results: List[AnswerResponseItem]
 
+def _cell_fingerprint(column: ColumnModel, documents) -> str:
+    """
+    Fingerprint of everything a cell answer depends on: the column prompt and
+    format and the content of the row's documents.
+    """
+    parts = [column.prompt, str(column.format)]
+    parts += sorted(f"{d.id}:{d.content_hash}" for d in documents)
+    return hash_text("\n".join(parts))
+
+async def _compute_cell(db: Session, item: AnswerItem, column: ColumnModel, doc_ids: List[str], deadline: Deadline):
+    rag_answer = await rag_pipeline(column.prompt, doc_ids, db, embedding_model, deadline=deadline)
+    answer_text = await profiling.to_thread(get_answer, column.prompt, rag_answer, column.format, len(doc_ids), deadline=deadline)
+    cell_id = save_cell(db, item.row_id, item.column_id, answer_text)
+    return answer_text, cell_id
+
 @app.post("/answer", response_model=AnswerResponse)
-async def answer(request: AnswerRequest, db: Session = Depends(get_db)):
+async def answer(
+    request: AnswerRequest,
+    db: Session = Depends(get_db),
+    x_request_timeout: float = Header(ANSWER_DEADLINE_S, gt=0, description="Deadline in seconds for each answered cell")
+):
     try:
         results: List[AnswerResponseItem] = []
         for item in request.items:
@@ -171,23 +219,24 @@ async def answer(request: AnswerRequest, db: Session = Depends(get_db)):
             if not column:
                 raise HTTPException(404, f"Column not found: {item.column_id}")
 
-            doc_ids_uuids = [
-                rd.document_id
-                for rd in db.query(row_documents)
-                         .filter_by(row_id=item.row_id)
-                         .all()
-            ]
-            doc_ids = [str(uuid_obj) for uuid_obj in doc_ids_uuids] # used for restricitng what to retrieve from pinecone
-
-            n_documents = len(doc_ids)
+            documents = (
+                db.query(DocumentModel)
+                  .join(row_documents, row_documents.c.document_id == DocumentModel.id)
+                  .filter(row_documents.c.row_id == item.row_id)
+                  .all()
+            )
+            doc_ids = [str(d.id) for d in documents] # used for restricitng what to retrieve from pinecone
             logger.info(f"doc_ids for row {item.row_id}: {doc_ids}")
 
             if not doc_ids:
                 raise HTTPException(404, f"Row {item.row_id} has no documents")
 
-            rag_answer = await rag_pipeline(column.prompt, doc_ids, db, embedding_model)
-            answer_text = get_answer(column.prompt, rag_answer, column.format, n_documents)
-            cell_id = save_cell(db, item.row_id, item.column_id, answer_text)
+            key = (item.row_id, item.column_id, _cell_fingerprint(column, documents))
+            # a request that waits for another request's computation of the cell keeps its own deadline
+            deadline = Deadline(x_request_timeout)
+            answer_text, cell_id = await answer_flight.do(
+                key, lambda: _compute_cell(db, item, column, doc_ids, deadline), timeout=x_request_timeout
+            )
             results.append(AnswerResponseItem(
                 row_id=item.row_id,
                 column_id=item.column_id,
@@ -197,10 +246,83 @@ async def answer(request: AnswerRequest, db: Session = Depends(get_db)):
 
         logger.info(f"answers: {results}")
         return {"results": results}
+    except (DeadlineExceeded, asyncio.TimeoutError) as e:
+        logger.error(f"Deadline exceeded while processing batch answers: {e}")
+        raise HTTPException(status_code=504, detail=str(e) or f"Cell not answered within {x_request_timeout}s")
     except Exception as e:
         logger.error(f"Error processing batch answers: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+@app.get("/metrics")
+def metrics():
+    return {
+        "singleflight": {flight.name: flight.stats() for flight in (upload_flight, answer_flight)},
+        "hedging": hedging_stats(),
+        "retrieval": retrieval_stats
+    }
+
+class ProfilingSettings(BaseModel):
+    enabled: bool = False
+    sample_rate: float = Field(0.0, ge=0.0, le=1.0)
+
+@app.get("/admin/profiling", response_model=ProfilingSettings)
+def get_profiling_settings():
+    return profiling.profiling_settings
+
+@app.post("/admin/profiling", response_model=ProfilingSettings)
+def set_profiling_settings(settings: ProfilingSettings):
+    profiling.profiling_settings.update(settings.model_dump())
+    logger.info(f"Profiling settings changed: {profiling.profiling_settings}")
+    return profiling.profiling_settings
+
+class ReindexResponse(BaseModel):
+    document_id: UUID
+    upserted: int
+
+@app.post("/admin/reindex/{document_id}", response_model=ReindexResponse)
+async def reindex(
+    document_id: UUID,
+    from_mode: Optional[Literal["shared", "document"]] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Upsert a document's vectors from its stored embeddings without calling Voyage,
+    e.g. after changing PINECONE_NAMESPACE_MODE (pass the previous mode as from_mode).
+    """
+    if db.get(DocumentModel, document_id) is None:
+        raise HTTPException(404, f"Document not found: {document_id}")
+    upserted = await profiling.to_thread(reindex_document, db, document_id, from_mode)
+    if upserted == 0:
+        raise HTTPException(409, "Document has no stored embeddings; set EMBEDDING_STORE_DTYPE and upload it again")
+    return {"document_id": document_id, "upserted": upserted}
+
+@app.get("/export")
+def export_grid(format: str = "csv"):
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(400, f"Invalid format, must be one of {', '.join(EXPORT_MEDIA_TYPES)}")
+    if format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(501, "Parquet export requires pyarrow")
+
+    return StreamingResponse(
+        profiling.iterate_profiled(stream_grid_export(format)),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="grid.{format}"'}
+    )
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True, log_level="info")
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prod", action="store_true", help="Run several workers without reload")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    if args.prod:
+        # Create the tables once here instead of in every worker
+        init_db()
+        os.environ["SKIP_DB_INIT"] = "1"
+        uvicorn.run("main:app", host="0.0.0.0", port=args.port, workers=args.workers, log_level="info")
+    else:
+        uvicorn.run("main:app", host="0.0.0.0", port=args.port, reload=True, log_level="info")
\ No newline at end of file
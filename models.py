@@ -1,5 +1,5 @@
 import enum
-from sqlalchemy import Column as SAColumn, Table, Text, DateTime, Date, Boolean, Numeric, CHAR, ForeignKey, UniqueConstraint, text, Integer
+from sqlalchemy import Column as SAColumn, Table, Text, DateTime, Date, Boolean, Numeric, CHAR, ForeignKey, UniqueConstraint, text, Integer, BigInteger, Float, LargeBinary, Index, literal_column
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import UUID, ENUM as PGEnum
 from database import Base
@@ -26,6 +26,11 @@ class Document(Base):
     filename = SAColumn(Text)
     uploaded_at = SAColumn(DateTime(timezone=True), server_default=func.now())
 
+    # change detection for re-ingestion
+    file_mtime = SAColumn(Float)
+    file_size = SAColumn(BigInteger)
+    content_hash = SAColumn(CHAR(64))
+
 # Rows table
 class Row(Base):
     __tablename__ = 'rows'
@@ -60,6 +65,8 @@ class Cell(Base):
     column_id = SAColumn(UUID(as_uuid=True), ForeignKey('columns.id', ondelete='CASCADE'), nullable=False)
     answer = SAColumn(Text)
     computed_at = SAColumn(DateTime(timezone=True), server_default=func.now())
+    # set when one of the row's documents changed after the answer was computed
+    stale = SAColumn(Boolean, nullable=False, server_default=text('false'))
 
     __table_args__ = (
         UniqueConstraint('row_id', 'column_id', name='uix_row_column'),
@@ -76,8 +83,34 @@ class Chunk(Base):
 
     text        = SAColumn(Text, nullable=False)
 
+    content_hash = SAColumn(CHAR(64))
+
+    # optional quantized copy of the chunk embedding (see EMBEDDING_STORE_DTYPE)
+    embedding = SAColumn(LargeBinary)
+    embedding_dtype = SAColumn(Text)
+    embedding_scale = SAColumn(Float)
+
+    # near-duplicate detection: MinHash signature, and the canonical chunk of the cluster
+    # (a near-duplicate in the same document has no vector of its own)
+    minhash = SAColumn(LargeBinary)
+    duplicate_of = SAColumn(UUID(as_uuid=True), ForeignKey('chunks.id', ondelete='SET NULL'))
+
     created_at  = SAColumn(DateTime(timezone=True), server_default=func.now())
 
     __table_args__ = (
         UniqueConstraint('document_id', 'chunk_index', name='uix_chunk_identity'),
-    )
\ No newline at end of file
+        # `text` is the column above here, not sqlalchemy.text
+        Index('ix_chunks_text_fts', func.to_tsvector(literal_column("'english'"), text), postgresql_using='gin'),
+    )
+
+# Full-text search vector of a chunk; queries must use this exact expression to hit ix_chunks_text_fts
+chunk_search_vector = func.to_tsvector(literal_column("'english'"), Chunk.text)
+
+# LSH buckets of canonical chunks, used to find near-duplicates across documents
+chunk_lsh_buckets = Table(
+    'chunk_lsh_buckets',
+    Base.metadata,
+    SAColumn('chunk_id', UUID(as_uuid=True), ForeignKey('chunks.id', ondelete='CASCADE'), primary_key=True),
+    SAColumn('bucket', BigInteger, primary_key=True),
+    Index('ix_chunk_lsh_buckets_bucket', 'bucket'),
+)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The tested modules never open a connection; database.py only needs a URL to build its engine
+os.environ.setdefault("POSTGRESQL_URL", "sqlite://")
+os.environ.setdefault("VECTOR_INDEX", "memory")
@@ -0,0 +1,50 @@
+import time
+import pytest
+from utils import deadline as dl
+from utils.deadline import Deadline, DeadlineExceeded, call_with_deadline
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(dl, "_stats", {name: dl._CallStats() for name in dl.CALL_TIMEOUTS})
+
+def test_result_and_errors_are_passed_through():
+    assert call_with_deadline("query", lambda x, y=0: x + y, 1, y=2) == 3
+
+    def fail():
+        raise ValueError("boom")
+    with pytest.raises(ValueError, match="boom"):
+        call_with_deadline("query", fail)
+
+def test_expired_deadline_fails_before_calling():
+    calls = []
+    with pytest.raises(DeadlineExceeded):
+        call_with_deadline("query", lambda: calls.append(1), deadline=Deadline(-1))
+    assert calls == []
+
+def test_slow_call_times_out_at_the_deadline():
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        call_with_deadline("rerank", time.sleep, 0.5, deadline=Deadline(0.05), hedge=False)
+    assert time.monotonic() - started < 0.4
+    assert dl.hedging_stats()["rerank"]["timeouts"] == 1
+
+def test_timeout_kwarg_gets_the_remaining_time():
+    received = {}
+    call_with_deadline("query", lambda timeout: received.setdefault("timeout", timeout), deadline=Deadline(4), timeout_kwarg="timeout")
+    assert 3.5 < received["timeout"] <= 4
+
+def test_stuck_calls_are_rejected_until_a_probe_succeeds(monkeypatch):
+    monkeypatch.setattr(dl, "MAX_ABANDONED_CALLS", 2)
+    for _ in range(2):
+        with pytest.raises(DeadlineExceeded):
+            call_with_deadline("generate", time.sleep, 0.3, deadline=Deadline(0.01), hedge=False)
+    # the first call after the limit is a probe; it hangs too
+    with pytest.raises(DeadlineExceeded):
+        call_with_deadline("generate", time.sleep, 0.3, deadline=Deadline(0.01), hedge=False)
+    with pytest.raises(DeadlineExceeded, match="not finishing"):
+        call_with_deadline("generate", lambda: 1)
+
+    dl._stats["generate"].last_probe = 0.0
+    assert call_with_deadline("generate", lambda: 1) == 1
+    assert call_with_deadline("generate", lambda: 2) == 2
+    assert dl.hedging_stats()["generate"]["rejected"] == 1
@@ -0,0 +1,47 @@
+from utils.dedup import (
+    NUM_PERM,
+    LSH_BANDS,
+    NEAR_DUPLICATE_THRESHOLD,
+    minhash_signature,
+    lsh_buckets,
+    similarity,
+    cluster_near_duplicates,
+    best_match,
+)
+
+CLAUSE = (
+    "The Supplier shall indemnify and hold harmless {party} and its affiliates, officers, directors and "
+    "employees from and against any and all losses, claims, damages, liabilities, costs and expenses "
+    "arising out of or relating to any breach of this Agreement by the Supplier."
+)
+OTHER = "Payment is due within thirty days of the invoice date, by wire transfer to the account named in Schedule B."
+
+def test_signature_is_deterministic():
+    a = minhash_signature(CLAUSE.format(party="Acme Corp"))
+    b = minhash_signature(CLAUSE.format(party="Acme Corp"))
+    assert a.shape == (NUM_PERM,)
+    assert (a == b).all()
+    assert len(lsh_buckets(a)) == LSH_BANDS
+
+def test_near_duplicates_are_similar_and_unrelated_texts_are_not():
+    acme = minhash_signature(CLAUSE.format(party="Acme Corp"))
+    bellring = minhash_signature(CLAUSE.format(party="Bellring Brands"))
+    other = minhash_signature(OTHER)
+    assert similarity(acme, bellring) >= NEAR_DUPLICATE_THRESHOLD
+    assert similarity(acme, other) < NEAR_DUPLICATE_THRESHOLD
+
+def test_cluster_maps_duplicates_to_the_first_text():
+    texts = {
+        "h1": CLAUSE.format(party="Acme Corp"),
+        "h2": OTHER,
+        "h3": CLAUSE.format(party="Bellring Brands"),
+    }
+    signatures = {h: minhash_signature(t) for h, t in texts.items()}
+    buckets = {h: lsh_buckets(s) for h, s in signatures.items()}
+    assert cluster_near_duplicates(signatures, buckets) == {"h3": "h1"}
+
+def test_best_match_respects_the_threshold():
+    acme = minhash_signature(CLAUSE.format(party="Acme Corp"))
+    candidates = [("other", minhash_signature(OTHER)), ("bellring", minhash_signature(CLAUSE.format(party="Bellring Brands")))]
+    assert best_match(acme, candidates) == "bellring"
+    assert best_match(acme, candidates[:1]) is None
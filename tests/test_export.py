@@ -0,0 +1,33 @@
+import csv
+import io
+import json
+import pytest
+from utils import export
+
+FIELDNAMES = ["row_id", "row_name", "Date", "Party"]
+
+def records(n):
+    return [{"row_id": str(i), "row_name": f"r{i}", "Date": "2020-01-01", "Party": "Acme, Inc" if i % 2 else None} for i in range(n)]
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 2)
+
+def test_csv_has_a_header_and_one_line_per_record():
+    parts = list(export._write_csv(FIELDNAMES, iter(records(5))))
+    assert len(parts) == 1 + 3  # header, then one part per batch
+    rows = list(csv.DictReader(io.StringIO("".join(parts))))
+    assert [r["row_id"] for r in rows] == ["0", "1", "2", "3", "4"]
+    assert rows[1]["Party"] == "Acme, Inc"
+    assert rows[0]["Party"] == ""
+
+def test_ndjson_round_trips():
+    lines = "".join(export._write_ndjson(FIELDNAMES, iter(records(3)))).splitlines()
+    assert [json.loads(line) for line in lines] == records(3)
+
+def test_parquet_writes_one_row_group_per_batch():
+    pq = pytest.importorskip("pyarrow.parquet")
+    data = b"".join(export._write_parquet(FIELDNAMES, iter(records(5))))
+    parquet_file = pq.ParquetFile(io.BytesIO(data))
+    assert parquet_file.num_row_groups == 3
+    assert parquet_file.read().to_pylist() == records(5)
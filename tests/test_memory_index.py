@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from utils import pinecone_util
+from utils.memory_index import InMemoryIndex
+
+DOC_A = "doc-a"
+DOC_B = "doc-b"
+EMBEDDINGS = {
+    DOC_A: [[1.0, 0.0, 0.0], [0.9, 0.1, 0.0]],
+    DOC_B: [[0.95, 0.05, 0.0], [0.0, 1.0, 0.0]],
+}
+
+def vector_id(document_id, i):
+    return f"{document_id}-hash-{i}"
+
+@pytest.fixture(params=["shared", "document"])
+def index(request, monkeypatch):
+    monkeypatch.setattr(pinecone_util, "PINECONE_NAMESPACE_MODE", request.param)
+    index = InMemoryIndex()
+    monkeypatch.setattr(pinecone_util, "get_index", lambda: index)
+    for document_id, embeddings in EMBEDDINGS.items():
+        ids = [vector_id(document_id, i) for i in range(len(embeddings))]
+        documents = pinecone_util.create_pinecone_documents(ids, np.array(embeddings, dtype=np.float32), document_id)
+        pinecone_util.upsert_documents(documents)
+    return index
+
+def match_ids(response):
+    return [m["metadata"]["chunk_id"] for m in response["matches"]]
+
+def test_vectors_go_to_the_namespace_of_the_mode(index):
+    if pinecone_util.PINECONE_NAMESPACE_MODE == "document":
+        assert set(index._namespaces) == {DOC_A, DOC_B}
+    else:
+        assert set(index._namespaces) == {""}
+
+def test_query_merges_documents_by_score(index):
+    response = pinecone_util.query_pinecone([1.0, 0.0, 0.0], [DOC_A, DOC_B], top_k=3)
+    assert match_ids(response) == [vector_id(DOC_A, 0), vector_id(DOC_B, 0), vector_id(DOC_A, 1)]
+    scores = [m["score"] for m in response["matches"]]
+    assert scores == sorted(scores, reverse=True)
+
+def test_query_only_returns_allowed_documents(index):
+    response = pinecone_util.query_pinecone([1.0, 0.0, 0.0], [DOC_B], top_k=10)
+    assert match_ids(response) == [vector_id(DOC_B, 0), vector_id(DOC_B, 1)]
+    assert {m["metadata"]["document_id"] for m in response["matches"]} == {DOC_B}
+
+def test_fetch_vectors_leaves_out_missing_ids(index):
+    vectors = pinecone_util.fetch_vectors([vector_id(DOC_A, 0), vector_id(DOC_A, 9)], DOC_A)
+    assert list(vectors) == [vector_id(DOC_A, 0)]
+    assert vectors[vector_id(DOC_A, 0)].dtype == np.float32
+    np.testing.assert_allclose(vectors[vector_id(DOC_A, 0)], [1.0, 0.0, 0.0])
+
+def test_delete_vectors(index):
+    pinecone_util.delete_vectors([vector_id(DOC_A, 0)], DOC_A)
+    response = pinecone_util.query_pinecone([1.0, 0.0, 0.0], [DOC_A, DOC_B], top_k=10)
+    assert vector_id(DOC_A, 0) not in match_ids(response)
+    assert len(response["matches"]) == 3
+    assert pinecone_util.fetch_vectors([vector_id(DOC_A, 0)], DOC_A) == {}
@@ -0,0 +1,18 @@
+import pytest
+from utils.rag_pipeline import RRF_K, reciprocal_rank_fusion, rankings_agree
+
+def test_reciprocal_rank_fusion_sums_reciprocal_ranks():
+    scores = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]])
+    assert scores["a"] == pytest.approx(1 / (RRF_K + 1) + 1 / (RRF_K + 2))
+    assert scores["b"] == pytest.approx(1 / (RRF_K + 2))
+    assert scores["c"] == pytest.approx(1 / (RRF_K + 3) + 1 / (RRF_K + 1))
+    assert sorted(scores, key=scores.get, reverse=True) == ["a", "c", "b"]
+
+def test_fusion_keeps_ids_found_by_one_ranking():
+    assert set(reciprocal_rank_fusion([["a"], []])) == {"a"}
+    assert reciprocal_rank_fusion([[], []]) == {}
+
+def test_rankings_agree_on_top_overlap():
+    assert rankings_agree(list("abcde"), list("abcxy"))
+    assert not rankings_agree(list("abcde"), list("abxyz"))
+    assert not rankings_agree(list("abcde"), [])
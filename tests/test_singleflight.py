@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from utils.singleflight import SingleFlight
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def _work(runs, tag, delay=0.05, error=None):
+    runs.append(tag)
+    await asyncio.sleep(delay)
+    if error:
+        raise error
+    return tag
+
+def test_concurrent_calls_share_one_run():
+    async def scenario():
+        flight, runs = SingleFlight("test"), []
+        results = await asyncio.gather(*(flight.do("k", lambda: _work(runs, "run")) for _ in range(5)))
+        return flight, runs, results
+    flight, runs, results = run(scenario())
+    assert results == ["run"] * 5
+    assert runs == ["run"]
+    assert flight.stats() == {"calls": 5, "executions": 1, "coalesced": 4, "in_flight": 0}
+
+def test_errors_reach_every_caller():
+    async def scenario():
+        flight, runs = SingleFlight("test"), []
+        return await asyncio.gather(
+            *(flight.do("k", lambda: _work(runs, "run", error=ValueError("boom"))) for _ in range(2)),
+            return_exceptions=True,
+        )
+    assert [str(e) for e in run(scenario())] == ["boom", "boom"]
+
+def test_follower_takes_over_when_the_leader_is_cancelled():
+    async def scenario():
+        flight, runs = SingleFlight("test"), []
+        leader = asyncio.create_task(flight.do("k", lambda: _work(runs, "leader")))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flight.do("k", lambda: _work(runs, "follower")))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower, runs
+    assert run(scenario()) == ("follower", ["leader", "follower"])
+
+def test_follower_gives_up_after_its_timeout():
+    async def scenario():
+        flight, runs = SingleFlight("test"), []
+        leader = asyncio.create_task(flight.do("k", lambda: _work(runs, "leader", delay=0.3)))
+        await asyncio.sleep(0.01)
+        with pytest.raises(asyncio.TimeoutError):
+            await flight.do("k", lambda: _work(runs, "follower"), timeout=0.05)
+        return await leader, runs
+    assert run(scenario()) == ("leader", ["leader"])
+
+def test_cancelled_follower_does_not_cancel_the_leader():
+    async def scenario():
+        flight, runs = SingleFlight("test"), []
+        leader = asyncio.create_task(flight.do("k", lambda: _work(runs, "leader")))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flight.do("k", lambda: _work(runs, "follower")))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+    assert run(scenario()) == "leader"
@@ -1,7 +1,9 @@
 from database import SessionLocal
-from models import Cell, Document, Chunk
+from models import Cell, Document, Chunk, row_documents, chunk_lsh_buckets, chunk_search_vector
 from typing import List
+from sqlalchemy import func, select, update, or_, and_
 import os
+import re
 from uuid import UUID
 
 # Dependency to get DB session
@@ -12,9 +14,10 @@ def get_db():
     finally:
         db.close()
 
-def save_document_chunks(file_ref: str, chunks: List[str]):
+def save_document_chunks(file_ref: str, chunks: List[str], chunk_hashes: List[str]):
     """
-    Create a new document entry and save its chunks in the database.
+    Create a new document entry and save its chunks in the database. The file
+    fingerprint is recorded separately with update_document_fingerprint.
     """
     session = SessionLocal()
     try:
@@ -26,11 +29,12 @@ def save_document_chunks(file_ref: str, chunks: List[str]):
         session.commit()
         session.refresh(document)
         # create chunks
-        for index, chunk_text in enumerate(chunks):
+        for index, (chunk_text, chunk_hash) in enumerate(zip(chunks, chunk_hashes)):
             chunk = Chunk(
                 document_id=document.id,
                 chunk_index=index,
-                text=chunk_text
+                text=chunk_text,
+                content_hash=chunk_hash
             )
             session.add(chunk)
         session.commit()
@@ -41,38 +45,264 @@ def save_document_chunks(file_ref: str, chunks: List[str]):
     finally:
         session.close()
 
-def get_chunks_by_ids(db, chunk_ids):
+def replace_document_chunks(
+    db,
+    document: Document,
+    chunks: List[str],
+    chunk_hashes: List[str],
+    file_mtime: float,
+    file_size: int,
+    content_hash: str,
+):
     """
-    Fetch chunk texts from the database given a list of chunk_ids of format '<document_id>-chunk-<index>'.
-    Returns a mapping from chunk_id to chunk text.
+    Replace the chunks of an existing document with a new chunking of its
+    changed content, and record the new file fingerprint.
+    """
+    try:
+        # keep the stored embeddings of chunks whose content did not change
+        stored_embeddings = {
+            c.content_hash: (c.embedding, c.embedding_dtype, c.embedding_scale)
+            for c in db.query(Chunk.content_hash, Chunk.embedding, Chunk.embedding_dtype, Chunk.embedding_scale).filter(
+                Chunk.document_id == document.id,
+                Chunk.embedding.isnot(None)
+            )
+        }
+        db.query(Chunk).filter(Chunk.document_id == document.id).delete(synchronize_session=False)
+        for index, (chunk_text, chunk_hash) in enumerate(zip(chunks, chunk_hashes)):
+            embedding, embedding_dtype, embedding_scale = stored_embeddings.get(chunk_hash, (None, None, None))
+            db.add(Chunk(
+                document_id=document.id,
+                chunk_index=index,
+                text=chunk_text,
+                content_hash=chunk_hash,
+                embedding=embedding,
+                embedding_dtype=embedding_dtype,
+                embedding_scale=embedding_scale
+            ))
+        document.file_mtime = file_mtime
+        document.file_size = file_size
+        document.content_hash = content_hash
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+def save_chunk_embeddings(db, document_id: UUID, chunk_hashes: List[str], blobs: List[bytes], dtype: str, scales=None):
+    """
+    Store quantized embeddings on the chunk rows of a document, matched by content hash.
+    """
+    by_hash = {
+        h: (blob, None if scales is None else float(scale))
+        for h, blob, scale in zip(chunk_hashes, blobs, scales if scales is not None else [None] * len(blobs))
+    }
+    rows = db.query(Chunk.id, Chunk.content_hash).filter(
+        Chunk.document_id == document_id,
+        Chunk.content_hash.in_(list(by_hash))
+    ).all()
+    if rows:
+        db.execute(update(Chunk), [
+            {
+                "id": r.id,
+                "embedding": by_hash[r.content_hash][0],
+                "embedding_dtype": dtype,
+                "embedding_scale": by_hash[r.content_hash][1]
+            }
+            for r in rows
+        ])
+    db.commit()
+
+def get_stored_embeddings(db, document_id: UUID):
     """
-    texts = {}
+    Fetch the locally stored embeddings of a document, one per distinct content hash.
+    Returns a list of (content_hash, blob, dtype, scale) tuples.
+    """
+    rows = db.query(Chunk.content_hash, Chunk.embedding, Chunk.embedding_dtype, Chunk.embedding_scale).filter(
+        Chunk.document_id == document_id,
+        Chunk.embedding.isnot(None)
+    ).order_by(Chunk.chunk_index).all()
+    seen = set()
+    result = []
+    for r in rows:
+        if r.content_hash not in seen:
+            seen.add(r.content_hash)
+            result.append((r.content_hash, r.embedding, r.embedding_dtype, r.embedding_scale))
+    return result
+
+def update_document_fingerprint(db, document: Document, file_mtime: float, file_size: int, content_hash: str):
+    """
+    Record the mtime, size and content hash of a document's file.
+    """
+    document.file_mtime = file_mtime
+    document.file_size = file_size
+    document.content_hash = content_hash
+    db.commit()
+
+def mark_cells_stale(db, document_id: UUID) -> int:
+    """
+    Mark all cells of rows that contain the document as stale.
+    Returns the number of cells marked.
+    """
+    row_ids = select(row_documents.c.row_id).where(row_documents.c.document_id == document_id)
+    count = db.query(Cell).filter(Cell.row_id.in_(row_ids)).update(
+        {Cell.stale: True}, synchronize_session=False
+    )
+    db.commit()
+    return count
+
+def chunk_vector_id(document_id, content_hash: str) -> str:
+    """
+    Vector id of a chunk, keyed by its content hash so unchanged chunks keep
+    their vector when a document is re-chunked.
+    """
+    return f"{document_id}-hash-{content_hash}"
+
+def get_chunk_records_by_ids(db, chunk_ids):
+    """
+    Fetch chunks from the database in one query given a list of chunk_ids of format
+    '<document_id>-hash-<content_hash>' (or the older '<document_id>-chunk-<index>').
+    Returns a mapping from chunk_id to {"text", "cluster"}, where chunks in the
+    same near-duplicate cluster share the same cluster id.
+    """
+    keys = {}
     for cid in chunk_ids:
         try:
-            doc_id_str, idx_str = cid.rsplit('-chunk-', 1)
-            doc_uuid = UUID(doc_id_str)
-            idx = int(idx_str)
+            if '-hash-' in cid:
+                doc_id_str, content_hash = cid.rsplit('-hash-', 1)
+                keys[(UUID(doc_id_str), content_hash)] = cid
+            else:
+                doc_id_str, idx_str = cid.rsplit('-chunk-', 1)
+                keys[(UUID(doc_id_str), int(idx_str))] = cid
         except ValueError:
             continue
-        chunk = db.query(Chunk).filter(
-            Chunk.document_id == doc_uuid,
-            Chunk.chunk_index == idx
-        ).first()
-        if chunk:
-            texts[cid] = chunk.text
-    return texts
+    if not keys:
+        return {}
+
+    conditions = [
+        and_(Chunk.document_id == doc_uuid, (Chunk.content_hash == key) if isinstance(key, str) else (Chunk.chunk_index == key))
+        for doc_uuid, key in keys
+    ]
+    rows = db.query(Chunk.id, Chunk.document_id, Chunk.chunk_index, Chunk.content_hash, Chunk.text, Chunk.duplicate_of).filter(
+        or_(*conditions)
+    ).order_by(Chunk.chunk_index).all()
+
+    records = {}
+    for r in rows:
+        cid = keys.get((r.document_id, r.content_hash)) or keys.get((r.document_id, r.chunk_index))
+        if cid and cid not in records:
+            records[cid] = {"text": r.text, "cluster": r.duplicate_of or r.id}
+    return records
+
+def get_chunks_by_ids(db, chunk_ids):
+    """
+    Fetch chunk texts from the database given a list of chunk_ids.
+    Returns a mapping from chunk_id to chunk text.
+    """
+    return {cid: record["text"] for cid, record in get_chunk_records_by_ids(db, chunk_ids).items()}
 
+def search_chunks_lexical(db, query: str, doc_ids, top_k: int = 20) -> List[str]:
+    """
+    Full-text search over the chunks of the given documents, served by the GIN
+    index on the chunk text. Query words are OR-ed, so chunks containing an exact
+    date, amount or name from the prompt match. Returns chunk ids in the vector id
+    format, best ts_rank_cd first.
+    """
+    terms = sorted(set(re.findall(r"[^\W_]+", query.lower())))
+    if not terms:
+        return []
+    ts_query = func.to_tsquery('english', " | ".join(terms))
+    rows = db.query(Chunk.document_id, Chunk.chunk_index, Chunk.content_hash).filter(
+        Chunk.document_id.in_(doc_ids),
+        chunk_search_vector.op('@@')(ts_query)
+    ).order_by(func.ts_rank_cd(chunk_search_vector, ts_query).desc(), Chunk.chunk_index).limit(top_k).all()
+    return [
+        chunk_vector_id(r.document_id, r.content_hash) if r.content_hash else f"{r.document_id}-chunk-{r.chunk_index}"
+        for r in rows
+    ]
+
+def find_near_duplicate_candidates(db, buckets: List[int], exclude_document_id: UUID, batch_size: int = 5000):
+    """
+    Find canonical chunks of other documents that share an LSH bucket.
+    Returns a mapping from bucket to rows with id, document_id, content_hash and minhash.
+    """
+    candidates = {}
+    buckets = list(set(buckets))
+    for i in range(0, len(buckets), batch_size):
+        rows = db.query(chunk_lsh_buckets.c.bucket, Chunk.id, Chunk.document_id, Chunk.content_hash, Chunk.minhash).join(
+            Chunk, Chunk.id == chunk_lsh_buckets.c.chunk_id
+        ).filter(
+            chunk_lsh_buckets.c.bucket.in_(buckets[i : i + batch_size]),
+            Chunk.document_id != exclude_document_id
+        ).all()
+        for r in rows:
+            candidates.setdefault(r.bucket, []).append(r)
+    return candidates
+
+def save_chunk_duplicates(db, document_id: UUID, signatures: dict, buckets: dict, within_document: dict, across_documents: dict):
+    """
+    Store MinHash signatures and near-duplicate links on the chunks of a document.
+
+    `signatures` and `buckets` are keyed by content hash, `within_document` maps a
+    content hash to the canonical content hash in the same document and
+    `across_documents` maps a content hash to the canonical chunk id in another
+    document. Canonical chunks get their LSH buckets recorded.
+    """
+    rows = db.query(Chunk.id, Chunk.content_hash).filter(Chunk.document_id == document_id).order_by(Chunk.chunk_index).all()
+    first_id_by_hash = {}
+    for r in rows:
+        first_id_by_hash.setdefault(r.content_hash, r.id)
+
+    updates = []
+    bucket_rows = []
+    for r in rows:
+        if r.content_hash in within_document:
+            duplicate_of = first_id_by_hash[within_document[r.content_hash]]
+        else:
+            duplicate_of = across_documents.get(r.content_hash)
+        updates.append({"id": r.id, "minhash": signatures[r.content_hash].tobytes(), "duplicate_of": duplicate_of})
+        if duplicate_of is None and first_id_by_hash[r.content_hash] == r.id:
+            bucket_rows += [{"chunk_id": r.id, "bucket": b} for b in set(buckets[r.content_hash])]
+    if updates:
+        db.execute(update(Chunk), updates)
+    if bucket_rows:
+        db.execute(chunk_lsh_buckets.insert(), bucket_rows)
+    db.commit()
+
+def get_documents_text_length(db, doc_ids) -> int:
+    """
+    Total number of characters stored in the chunks of the given documents.
+    """
+    return db.query(func.coalesce(func.sum(func.length(Chunk.text)), 0)).filter(
+        Chunk.document_id.in_(doc_ids)
+    ).scalar()
+
+def get_documents_chunk_texts(db, doc_ids) -> List[str]:
+    """
+    Fetch all chunk texts of the given documents, in the order of `doc_ids`
+    and then by chunk_index.
+    """
+    rows = db.query(Chunk.document_id, Chunk.text).filter(
+        Chunk.document_id.in_(doc_ids)
+    ).order_by(Chunk.chunk_index).all()
+    doc_order = {str(doc_id): i for i, doc_id in enumerate(doc_ids)}
+    rows = sorted(rows, key=lambda r: doc_order[str(r.document_id)])  # stable, keeps chunk_index order
+    return [r.text for r in rows]
 
 def save_cell(db, row_id: UUID, column_id: UUID, answer: str):
     """
-    Save a cell to the database.
+    Save a cell to the database, replacing an earlier answer for the same row and column.
     """
-    cell = Cell(
-        row_id=row_id,
-        column_id=column_id,
-        answer=answer
-    )
-    db.add(cell)
+    cell = db.query(Cell).filter(Cell.row_id == row_id, Cell.column_id == column_id).first()
+    if cell:
+        cell.answer = answer
+        cell.stale = False
+        cell.computed_at = func.now()
+    else:
+        cell = Cell(
+            row_id=row_id,
+            column_id=column_id,
+            answer=answer
+        )
+        db.add(cell)
     db.commit()
     db.refresh(cell)
     return cell.id
\ No newline at end of file
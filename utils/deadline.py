@@ -0,0 +1,194 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Optional
+from utils.profiling import run_profiled
+
+logger = logging.getLogger(__name__)
+
+# Timeout budget (seconds) of a single provider call, capped by the request deadline
+CALL_TIMEOUTS = {
+    "embed_query": 10.0,
+    "embed_document": 30.0,
+    "query": 10.0,
+    "rerank": 15.0,
+    "count_tokens": 10.0,
+    "generate": 60.0,
+}
+
+# Maximum fraction of calls that may be hedged with a duplicate request
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.05"))
+# Latency samples needed before the p95 is trusted as a hedge delay
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+# Worker threads per call type; each type has its own pool, so calls stuck on one
+# provider cannot starve the others
+PROVIDER_WORKERS = 32
+# Calls of one type still running after their caller gave up, above which new calls
+# fail immediately instead of queueing behind them (except one probe call per
+# CALL_TIMEOUTS[name] seconds)
+MAX_ABANDONED_CALLS = PROVIDER_WORKERS // 2
+
+_executors = {
+    name: ThreadPoolExecutor(max_workers=PROVIDER_WORKERS, thread_name_prefix=f"provider-{name}")
+    for name in CALL_TIMEOUTS
+}
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+class Deadline:
+    """Absolute point in time by which a request must be answered."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def timeout(self, cap: float) -> float:
+        """Time left for a call with budget `cap`. Raises DeadlineExceeded when none is left."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline of {self.seconds}s exceeded")
+        return min(remaining, cap)
+
+class _CallStats:
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.abandoned = 0
+        # abandoned calls that no longer count against MAX_ABANDONED_CALLS, because a
+        # later call of the same type succeeded
+        self.written_off = 0
+        self.last_probe = 0.0
+        self.lock = threading.Lock()
+
+    def p95(self) -> Optional[float]:
+        with self.lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "abandoned": self.abandoned,
+            "hedge_rate": self.hedged / self.calls if self.calls else 0.0,
+            "p95_s": self.p95(),
+        }
+
+_stats: Dict[str, _CallStats] = {name: _CallStats() for name in CALL_TIMEOUTS}
+
+def hedging_stats() -> dict:
+    return {name: stats.as_dict() for name, stats in _stats.items()}
+
+def _timed(fn: Callable, args, kwargs):
+    started = time.monotonic()
+    result = run_profiled(fn, *args, **kwargs)
+    return result, time.monotonic() - started
+
+def _release_abandoned(stats: _CallStats):
+    with stats.lock:
+        stats.abandoned -= 1
+        stats.written_off = min(stats.written_off, stats.abandoned)
+
+def call_with_deadline(
+    name: str,
+    fn: Callable[..., Any],
+    *args,
+    deadline: Optional[Deadline] = None,
+    hedge: bool = True,
+    timeout_kwarg: Optional[str] = None,
+    **kwargs,
+) -> Any:
+    """
+    Call an idempotent provider function with a timeout of CALL_TIMEOUTS[name],
+    capped by `deadline`. When `hedge` is set and the call is still running
+    after the recent p95 latency, a duplicate request is sent and the first
+    response wins, as long as the hedged share stays below HEDGE_MAX_RATE.
+
+    A call that times out keeps running in its thread; only the caller stops
+    waiting. Clients are created with native timeouts where the SDK supports
+    them so such calls end, and `timeout_kwarg` names the argument of `fn`
+    that takes the remaining time in seconds, when it has one.
+
+    While MAX_ABANDONED_CALLS calls of this type are still running, new calls
+    fail immediately, apart from one probe call per CALL_TIMEOUTS[name]
+    seconds. A successful call writes the stuck calls off, so a type recovers
+    with its provider even if those calls never end.
+    """
+    stats = _stats[name]
+    cap = CALL_TIMEOUTS[name]
+    timeout = deadline.timeout(cap) if deadline else cap
+    started = time.monotonic()
+
+    def submit():
+        call_kwargs = kwargs
+        if timeout_kwarg:
+            call_kwargs = {**kwargs, timeout_kwarg: timeout - (time.monotonic() - started)}
+        # run in a copy of the caller's context so context variables carry over
+        context = contextvars.copy_context()
+        return _executors[name].submit(context.run, _timed, fn, args, call_kwargs)
+
+    with stats.lock:
+        stats.calls += 1
+        if stats.abandoned - stats.written_off >= MAX_ABANDONED_CALLS:
+            if time.monotonic() - stats.last_probe < cap:
+                stats.rejected += 1
+                raise DeadlineExceeded(f"{name} calls are not finishing ({stats.abandoned} still running)")
+            stats.last_probe = time.monotonic()
+    futures = [submit()]
+
+    hedge_delay = stats.p95() if hedge else None
+    if hedge_delay is not None and hedge_delay < timeout:
+        done, _ = wait(futures, timeout=hedge_delay)
+        if not done:
+            with stats.lock:
+                allowed = stats.hedged < HEDGE_MAX_RATE * stats.calls
+                if allowed:
+                    stats.hedged += 1
+            if allowed:
+                logger.info(f"Hedging {name} call after {hedge_delay:.2f}s")
+                futures.append(submit())
+
+    pending = set(futures)
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=timeout - (time.monotonic() - started), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            result, latency = future.result()
+            with stats.lock:
+                stats.latencies.append(latency)
+                stats.written_off = stats.abandoned
+                if future is not futures[0]:
+                    stats.hedge_wins += 1
+            return result
+
+    if error is not None and not pending:
+        raise error
+    with stats.lock:
+        stats.timeouts += 1
+        stats.abandoned += len(pending)
+    for future in pending:
+        future.add_done_callback(lambda _: _release_abandoned(stats))
+    raise DeadlineExceeded(f"{name} call did not finish within {timeout:.1f}s")
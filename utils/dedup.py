@@ -0,0 +1,89 @@
+import hashlib
+import re
+from typing import Dict, List, Tuple
+import numpy as np
+
+# MinHash signature length, split into LSH bands of NUM_PERM // LSH_BANDS rows
+NUM_PERM = 64
+LSH_BANDS = 16
+# Words per shingle
+SHINGLE_SIZE = 3
+# Estimated Jaccard similarity above which two chunks count as near-duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.7
+
+_MERSENNE_PRIME = (1 << 31) - 1
+
+def _seeded_ints(prefix: str) -> np.ndarray:
+    # derived from a hash rather than a RNG so signatures are stable across processes and versions
+    return np.array(
+        [int.from_bytes(hashlib.blake2b(f"{prefix}{i}".encode(), digest_size=4).digest(), "little") % (_MERSENNE_PRIME - 1) + 1
+         for i in range(NUM_PERM)],
+        dtype=np.uint64,
+    )
+
+_PERM_A = _seeded_ints("a")
+_PERM_B = _seeded_ints("b")
+
+def _shingles(text: str) -> List[str]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return [" ".join(words)]
+    return [" ".join(words[i : i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+
+def minhash_signature(text: str) -> np.ndarray:
+    """MinHash signature (NUM_PERM uint32 values) of the word shingles of a text."""
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "little") for s in set(_shingles(text))],
+        dtype=np.uint64,
+    )
+    permuted = (hashes[:, None] * _PERM_A[None, :] + _PERM_B[None, :]) % _MERSENNE_PRIME
+    return permuted.min(axis=0).astype(np.uint32)
+
+def lsh_buckets(signature: np.ndarray) -> List[int]:
+    """
+    One bucket key per LSH band. The band number is part of the hashed bytes,
+    so equal keys always come from the same band.
+    """
+    rows = NUM_PERM // LSH_BANDS
+    return [
+        int.from_bytes(
+            hashlib.blake2b(bytes([band]) + signature[band * rows : (band + 1) * rows].tobytes(), digest_size=8).digest(),
+            "little",
+            signed=True,
+        )
+        for band in range(LSH_BANDS)
+    ]
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of two MinHash signatures."""
+    return float(np.mean(a == b))
+
+def cluster_near_duplicates(signatures: Dict[str, np.ndarray], buckets: Dict[str, List[int]]) -> Dict[str, str]:
+    """
+    Group near-duplicate texts, keyed by content hash in document order. The
+    first text of a cluster is its canonical member.
+    Returns a mapping from each non-canonical hash to its canonical hash.
+    """
+    canonical_by_bucket: Dict[int, List[str]] = {}
+    duplicate_of = {}
+    for content_hash, signature in signatures.items():
+        candidates = {c for bucket in buckets[content_hash] for c in canonical_by_bucket.get(bucket, [])}
+        best = max(candidates, key=lambda c: similarity(signature, signatures[c]), default=None)
+        if best is not None and similarity(signature, signatures[best]) >= NEAR_DUPLICATE_THRESHOLD:
+            duplicate_of[content_hash] = best
+        else:
+            for bucket in buckets[content_hash]:
+                canonical_by_bucket.setdefault(bucket, []).append(content_hash)
+    return duplicate_of
+
+def best_match(signature: np.ndarray, candidates: List[Tuple[object, np.ndarray]]):
+    """
+    Return the candidate key whose signature is most similar to `signature`,
+    if it reaches NEAR_DUPLICATE_THRESHOLD, else None.
+    """
+    best_key, best_similarity = None, NEAR_DUPLICATE_THRESHOLD
+    for key, candidate in candidates:
+        s = similarity(signature, candidate)
+        if s >= best_similarity:
+            best_key, best_similarity = key, s
+    return best_key
@@ -1,18 +1,35 @@
 import asyncio
-import voyageai
-from typing import List, Union
+from typing import List, Union, Optional, Tuple
 import logging
 import os
+import numpy as np
 from constants import MAX_EMBEDDING_LENGTH
+from utils.deadline import Deadline, call_with_deadline, CALL_TIMEOUTS
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of texts per Voyage embed call
+VOYAGE_BATCH_SIZE = 128
+
+# Dtype of the local embedding copy kept in the chunks table: "float16", "int8" or "" (disabled)
+EMBEDDING_STORE_DTYPE = os.getenv("EMBEDDING_STORE_DTYPE", "")
+
 class VoyageEmbeddings:
     def __init__(self):
-        """Initialize the Voyage embeddings client."""
-        self.client = voyageai.Client(os.getenv('VOYAGE_API_KEY'))
+        """Initialize the Voyage embeddings wrapper. The client itself is created on first use."""
+        self._client = None
         self.model = "voyage-law-2"
 
+    @property
+    def client(self):
+        """Lazily create the Voyage client."""
+        if self._client is None:
+            import voyageai
+            # native timeout, so calls abandoned by call_with_deadline still end
+            timeout = max(CALL_TIMEOUTS["embed_query"], CALL_TIMEOUTS["embed_document"])
+            self._client = voyageai.Client(os.getenv('VOYAGE_API_KEY'), timeout=timeout)
+        return self._client
+
     def embed_query(self, text: str, input_type: str = "query") -> List[float]:
         """Get embedding for a single text using a synchronous call to Voyage."""
         # Check if text exceeds maximum length
@@ -26,23 +43,66 @@ class VoyageEmbeddings:
             logger.error(f"Unexpected error: {str(e)}")
             raise
 
-    def get_embeddings(self, texts: Union[str, List[str]], input_type: str = "document") -> List[List[float]]:
+    def get_embeddings(self, texts: Union[str, List[str]], input_type: str = "document", deadline: Optional[Deadline] = None) -> np.ndarray:
         """Get embeddings for one or more texts synchronously using Voyage.
-        
-        This method now uses the batch API provided by voyageai.Client.embed.
+
+        Texts are sent in batches of VOYAGE_BATCH_SIZE and written into a single
+        (n, dim) float32 array. Each batch call is bounded by the embed timeout
+        budget and `deadline`. Query embeds are hedged when slow; document
+        batches are not, as duplicating them would double the most expensive calls.
         """
         # Ensure texts is a list
         if isinstance(texts, str):
             texts = [texts]
 
         logger.debug(f"Getting batch embeddings (Voyage) with input_type='{input_type}' for {len(texts)} texts")
-        # Call the client embed method directly as it's now a synchronous method
-        result = self.client.embed(
-            texts,
-            model=self.model,
-            input_type=input_type,
-            truncation=True
-        )
-        
-        # result.embeddings is a list of embeddings for the batch of texts.
-        return result.embeddings
\ No newline at end of file
+        # single-text queries and large document batches have separate latency stats
+        call_name = "embed_query" if input_type == "query" else "embed_document"
+        embeddings = None
+        for i in range(0, len(texts), VOYAGE_BATCH_SIZE):
+            result = call_with_deadline(
+                call_name,
+                self.client.embed,
+                texts[i : i + VOYAGE_BATCH_SIZE],
+                deadline=deadline,
+                hedge=call_name == "embed_query",
+                model=self.model,
+                input_type=input_type,
+                truncation=True
+            )
+            batch = np.asarray(result.embeddings, dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            embeddings[i : i + len(batch)] = batch
+
+        if embeddings is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return embeddings
+
+def quantize_embeddings(embeddings: np.ndarray, dtype: str) -> Tuple[List[bytes], Optional[np.ndarray]]:
+    """
+    Quantize a (n, dim) float32 array for local storage.
+
+    Returns one byte string per row, and for int8 the per-row scale needed to
+    dequantize (None for float16).
+    """
+    if dtype == "float16":
+        quantized = embeddings.astype(np.float16)
+        return [row.tobytes() for row in quantized], None
+    if dtype == "int8":
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return [row.tobytes() for row in quantized], scales
+    raise ValueError(f"Unsupported embedding store dtype: {dtype}")
+
+def dequantize_embeddings(blobs: List[bytes], dtype: str, scales: Optional[List[float]] = None) -> np.ndarray:
+    """
+    Turn stored embedding blobs back into a (n, dim) float32 array.
+    """
+    if not blobs:
+        return np.empty((0, 0), dtype=np.float32)
+    embeddings = np.stack([np.frombuffer(blob, dtype=np.dtype(dtype)) for blob in blobs]).astype(np.float32)
+    if dtype == "int8":
+        embeddings *= np.asarray(scales, dtype=np.float32)[:, None]
+    return embeddings
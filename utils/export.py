@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+import logging
+from typing import Dict, Iterator, List, Tuple
+from uuid import UUID
+from sqlalchemy import select
+from database import SessionLocal
+from models import Row, Column, Cell
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per server-side cursor round trip, and rows per written batch
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Fixed fields that precede the column answers in every record
+ROW_FIELDS = ["row_id", "row_name"]
+
+def _get_column_names(db) -> Tuple[Dict[UUID, str], List[str]]:
+    """
+    Map column ids to output field names (the label, suffixed with the id when
+    labels collide with each other or with ROW_FIELDS) and return the field
+    names in output order.
+    """
+    columns = db.query(Column.id, Column.label).order_by(Column.label, Column.id).all()
+    label_counts = {}
+    for c in columns:
+        label_counts[c.label] = label_counts.get(c.label, 0) + 1
+    names = {
+        c.id: c.label if label_counts[c.label] == 1 and c.label not in ROW_FIELDS else f"{c.label} ({c.id})"
+        for c in columns
+    }
+    return names, ROW_FIELDS + [names[c.id] for c in columns]
+
+def iter_grid(db, column_names: Dict[UUID, str]) -> Iterator[dict]:
+    """
+    Yield one dict per row with the answer of every column, reading the
+    rows x cells join through a server-side cursor ordered by row.
+    """
+    stmt = (
+        select(Row.id, Row.name, Cell.column_id, Cell.answer)
+        .select_from(Row)
+        .outerjoin(Cell, Cell.row_id == Row.id)
+        .order_by(Row.id)
+        .execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE)
+    )
+    record = None
+    row_id = None
+    for r in db.execute(stmt):
+        if record is None or row_id != r.id:
+            if record is not None:
+                yield record
+            row_id = r.id
+            record = {"row_id": str(r.id), "row_name": r.name}
+            record.update({name: None for name in column_names.values()})
+        if r.column_id in column_names:
+            record[column_names[r.column_id]] = r.answer
+    if record is not None:
+        yield record
+
+def _batches(records: Iterator[dict]) -> Iterator[List[dict]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _write_csv(fieldnames: List[str], records: Iterator[dict]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    writer.writeheader()
+    yield buffer.getvalue()
+    for batch in _batches(records):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+def _write_ndjson(fieldnames: List[str], records: Iterator[dict]) -> Iterator[str]:
+    for batch in _batches(records):
+        yield "".join(json.dumps(record) + "\n" for record in batch)
+
+class _ByteSink(io.RawIOBase):
+    """Write-only file object whose contents are drained after every row group."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+def _write_parquet(fieldnames: List[str], records: Iterator[dict]) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(name, pa.string()) for name in fieldnames])
+    sink = _ByteSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        # one row group per batch, so bytes go out as soon as a batch is written
+        for batch in _batches(records):
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+EXPORT_WRITERS = {
+    "csv": _write_csv,
+    "ndjson": _write_ndjson,
+    "parquet": _write_parquet,
+}
+
+def stream_grid_export(format: str) -> Iterator:
+    """
+    Stream the rows x columns answer grid in the given format. Uses its own
+    session, which stays open until the last batch has been sent.
+    """
+    db = SessionLocal()
+    try:
+        column_names, fieldnames = _get_column_names(db)
+        n_parts = 0
+        for part in EXPORT_WRITERS[format](fieldnames, iter_grid(db, column_names)):
+            n_parts += 1
+            yield part
+        logger.info(f"Exported grid as {format} in {n_parts} parts")
+    finally:
+        db.close()
@@ -0,0 +1,221 @@
+import os
+import logging
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+import numpy as np
+from sqlalchemy.orm import Session
+from models import Document, Chunk
+from utils.text import get_text_from_file, hash_text, TextSplitter
+from utils.embedding import VoyageEmbeddings, EMBEDDING_STORE_DTYPE, quantize_embeddings, dequantize_embeddings
+from utils.pinecone_util import upsert_documents, create_pinecone_documents, delete_vectors, fetch_vectors, namespace_for
+from utils.dedup import minhash_signature, lsh_buckets, cluster_near_duplicates, best_match
+from utils.database_util import (
+    save_document_chunks,
+    replace_document_chunks,
+    update_document_fingerprint,
+    mark_cells_stale,
+    save_chunk_embeddings,
+    get_stored_embeddings,
+    find_near_duplicate_candidates,
+    save_chunk_duplicates,
+    chunk_vector_id,
+)
+
+logger = logging.getLogger(__name__)
+
+def get_file_fingerprint(file_ref: str) -> Tuple[float, int]:
+    """Return the (mtime, size) of a file."""
+    stat = os.stat(file_ref)
+    return stat.st_mtime, stat.st_size
+
+def _plan_near_duplicates(db: Session, document_id: UUID, chunks: List[str], chunk_hashes: List[str]):
+    """
+    Compute MinHash signatures of the distinct chunks and find their near-duplicates,
+    both within the document and among canonical chunks of other documents.
+    Returns (signatures, buckets, within_document, across_documents), where
+    across_documents maps a content hash to the matching chunk row.
+    """
+    texts = dict(zip(chunk_hashes, chunks))
+    signatures = {h: minhash_signature(t) for h, t in texts.items()}
+    buckets = {h: lsh_buckets(sig) for h, sig in signatures.items()}
+    within_document = cluster_near_duplicates(signatures, buckets)
+
+    canonical_hashes = [h for h in signatures if h not in within_document]
+    candidates = find_near_duplicate_candidates(db, [b for h in canonical_hashes for b in buckets[h]], document_id)
+    across_documents = {}
+    for h in canonical_hashes:
+        rows = {r.id: r for b in buckets[h] for r in candidates.get(b, [])}
+        match = best_match(signatures[h], [(r.id, np.frombuffer(r.minhash, dtype=np.uint32)) for r in rows.values()])
+        if match is not None:
+            across_documents[h] = rows[match]
+
+    logger.info(
+        f"Near-duplicates: {len(within_document)} within the document, "
+        f"{len(across_documents)} of chunks in other documents, out of {len(signatures)} distinct chunks"
+    )
+    return signatures, buckets, within_document, across_documents
+
+def _reusable_vectors(across_documents: dict) -> Dict[str, np.ndarray]:
+    """
+    Fetch the vectors of the canonical chunks in other documents, so their
+    near-duplicates are upserted without being embedded again.
+    """
+    by_document = {}
+    for h, row in across_documents.items():
+        by_document.setdefault(row.document_id, {})[chunk_vector_id(row.document_id, row.content_hash)] = h
+    vectors = {}
+    for canonical_document_id, hash_by_vector_id in by_document.items():
+        for vector_id, values in fetch_vectors(list(hash_by_vector_id), canonical_document_id).items():
+            vectors[hash_by_vector_id[vector_id]] = values
+    return vectors
+
+def _embed_and_upsert(
+    document_id: UUID,
+    chunks: List[str],
+    chunk_hashes: List[str],
+    skip_hashes: set,
+    embedding_model: VoyageEmbeddings,
+    reused_vectors: Optional[Dict[str, np.ndarray]] = None,
+) -> Tuple[List[str], np.ndarray]:
+    """
+    Upsert a vector for every distinct chunk hash not in `skip_hashes`. Hashes in
+    `reused_vectors` take that vector, the others are embedded.
+    Returns the upserted hashes and their (n, dim) float32 embeddings.
+    """
+    reused_vectors = reused_vectors or {}
+    to_embed = {}
+    for chunk_text, chunk_hash in zip(chunks, chunk_hashes):
+        if chunk_hash not in skip_hashes and chunk_hash not in reused_vectors and chunk_hash not in to_embed:
+            to_embed[chunk_hash] = chunk_text
+    reused_hashes = [h for h in dict.fromkeys(chunk_hashes) if h in reused_vectors and h not in skip_hashes]
+
+    parts = []
+    if to_embed:
+        parts.append(embedding_model.get_embeddings(list(to_embed.values()), input_type="document"))
+        logger.info(f"got embeddings {parts[0].shape}")
+    if reused_hashes:
+        parts.append(np.stack([reused_vectors[h] for h in reused_hashes]))
+        logger.info(f"reusing {len(reused_hashes)} embeddings of near-duplicate chunks")
+    if not parts:
+        return [], np.empty((0, 0), dtype=np.float32)
+
+    embeddings = np.concatenate(parts).astype(np.float32, copy=False)
+    upserted_hashes = list(to_embed) + reused_hashes
+    chunk_ids = [chunk_vector_id(document_id, h) for h in upserted_hashes]
+    pinecone_documents = create_pinecone_documents(chunk_ids, embeddings, str(document_id))
+    upsert_documents(pinecone_documents)
+    return upserted_hashes, embeddings
+
+def _store_embeddings(db: Session, document_id: UUID, chunk_hashes: List[str], embeddings: np.ndarray) -> None:
+    """
+    Keep a quantized local copy of the embeddings when EMBEDDING_STORE_DTYPE is set.
+    """
+    if not EMBEDDING_STORE_DTYPE or not chunk_hashes:
+        return
+    blobs, scales = quantize_embeddings(embeddings, EMBEDDING_STORE_DTYPE)
+    save_chunk_embeddings(db, document_id, chunk_hashes, blobs, EMBEDDING_STORE_DTYPE, scales)
+
+def reindex_document(db: Session, document_id: UUID, from_mode: Optional[str] = None) -> int:
+    """
+    Upsert a document's vectors again from the locally stored embeddings,
+    without calling Voyage. When `from_mode` names the PINECONE_NAMESPACE_MODE
+    the document was indexed in, the vectors are then deleted from that mode's
+    namespace, so they are moved rather than copied.
+    Returns the number of upserted vectors.
+    """
+    stored = get_stored_embeddings(db, document_id)
+    by_dtype = {}
+    for content_hash, blob, dtype, scale in stored:
+        by_dtype.setdefault(dtype, []).append((content_hash, blob, scale))
+
+    chunk_ids = []
+    for dtype, items in by_dtype.items():
+        embeddings = dequantize_embeddings([blob for _, blob, _ in items], dtype, [scale for _, _, scale in items])
+        dtype_chunk_ids = [chunk_vector_id(document_id, content_hash) for content_hash, _, _ in items]
+        upsert_documents(create_pinecone_documents(dtype_chunk_ids, embeddings, str(document_id)))
+        chunk_ids += dtype_chunk_ids
+
+    old_namespace = namespace_for(document_id, from_mode) if from_mode else None
+    if old_namespace is not None and old_namespace != namespace_for(document_id):
+        delete_vectors(chunk_ids, document_id, namespace=old_namespace)
+    logger.info(f"Re-indexed {len(stored)} vectors of document {document_id} from stored embeddings")
+    return len(stored)
+
+def ingest_document(
+    db: Session,
+    file_ref: str,
+    chunker: TextSplitter,
+    embedding_model: VoyageEmbeddings,
+) -> Tuple[str, UUID]:
+    """
+    Ingest a file, or re-ingest it if it changed since the last upload.
+
+    An unchanged mtime and size short-circuit without reading the file. A
+    changed file is re-chunked and only chunks with a new content hash are
+    embedded; vectors of chunks that disappeared are deleted and the cells
+    of rows containing the document are marked stale.
+
+    Returns a (message, document_id) tuple.
+    """
+    file_mtime, file_size = get_file_fingerprint(file_ref)
+
+    existing_document = db.query(Document).filter(Document.file_ref == file_ref).first()
+    if existing_document and existing_document.file_mtime == file_mtime and existing_document.file_size == file_size:
+        return "Document already uploaded", existing_document.id
+
+    text = get_text_from_file(file_ref)
+    logger.info(f"got text {text[:100]}")
+    content_hash = hash_text(text)
+
+    if existing_document and existing_document.content_hash == content_hash:
+        update_document_fingerprint(db, existing_document, file_mtime, file_size, content_hash)
+        return "Document already uploaded", existing_document.id
+
+    chunks = chunker.split_text(text)
+    chunk_hashes = [hash_text(c) for c in chunks]
+    logger.info(f"got chunks {len(chunks)}")
+
+    if existing_document is None:
+        # save the chunks to the database; the fingerprint is recorded only once the vectors
+        # are upserted, so a failed upload is ingested again on retry
+        document_id = save_document_chunks(file_ref, chunks, chunk_hashes)
+        signatures, buckets, within_document, across_documents = _plan_near_duplicates(db, document_id, chunks, chunk_hashes)
+        # near-duplicates within the document get no vector of their own
+        embedded_hashes, embeddings = _embed_and_upsert(
+            document_id, chunks, chunk_hashes, set(within_document), embedding_model, _reusable_vectors(across_documents)
+        )
+        _store_embeddings(db, document_id, embedded_hashes, embeddings)
+        save_chunk_duplicates(db, document_id, signatures, buckets, within_document, {h: r.id for h, r in across_documents.items()})
+        update_document_fingerprint(db, db.get(Document, document_id), file_mtime, file_size, content_hash)
+        return "Document uploaded successfully", document_id
+
+    document_id = existing_document.id
+    old_chunks = db.query(Chunk.id, Chunk.chunk_index, Chunk.content_hash, Chunk.duplicate_of).filter(Chunk.document_id == document_id).all()
+    old_chunk_ids = {c.id for c in old_chunks}
+    # chunks stored before content hashing have index-based vector ids and are re-embedded once;
+    # near-duplicates of a chunk in the same document have no vector. A document without a
+    # content hash never finished its first upload, so none of its chunks is known to be upserted
+    known_hashes = {
+        c.content_hash for c in old_chunks
+        if c.content_hash and c.duplicate_of not in old_chunk_ids
+    } if existing_document.content_hash else set()
+    signatures, buckets, within_document, across_documents = _plan_near_duplicates(db, document_id, chunks, chunk_hashes)
+    new_hashes = set(chunk_hashes) - set(within_document)
+    stale_vector_ids = [chunk_vector_id(document_id, h) for h in known_hashes - new_hashes]
+    stale_vector_ids += [f"{document_id}-chunk-{c.chunk_index}" for c in old_chunks if not c.content_hash]
+
+    reused_vectors = _reusable_vectors({h: r for h, r in across_documents.items() if h not in known_hashes})
+    embedded_hashes, embeddings = _embed_and_upsert(
+        document_id, chunks, chunk_hashes, known_hashes | set(within_document), embedding_model, reused_vectors
+    )
+    replace_document_chunks(db, existing_document, chunks, chunk_hashes, file_mtime, file_size, content_hash)
+    _store_embeddings(db, document_id, embedded_hashes, embeddings)
+    save_chunk_duplicates(db, document_id, signatures, buckets, within_document, {h: r.id for h, r in across_documents.items()})
+    n_stale_cells = mark_cells_stale(db, document_id)
+    delete_vectors(stale_vector_ids, document_id)
+
+    logger.info(
+        f"Re-ingested {file_ref}: {len(embedded_hashes)} of {len(chunks)} chunks upserted, "
+        f"{len(stale_vector_ids)} vectors deleted, {n_stale_cells} cells marked stale"
+    )
+    return "Document updated", document_id
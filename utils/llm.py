@@ -1,19 +1,29 @@
-from google import genai
 import logging
 from dotenv import load_dotenv
 import os
 import re
 from pydantic import BaseModel, field_validator, ValidationError
-from typing import Union, Literal
+from typing import Union, Literal, Optional
+from functools import lru_cache
 from models import AnswerFormat
+from utils.deadline import Deadline, call_with_deadline, CALL_TIMEOUTS
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-
-# Gemini client and model constants
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    Lazily create the Gemini client on first use instead of at import time.
+    """
+    from google import genai
+    from google.genai import types
+    # native timeout (milliseconds), so calls abandoned by call_with_deadline still end
+    timeout_ms = int(1000 * max(CALL_TIMEOUTS["generate"], CALL_TIMEOUTS["count_tokens"]))
+    return genai.Client(api_key=os.getenv("GEMINI_API_KEY"), http_options=types.HttpOptions(timeout=timeout_ms))
+
+# Gemini model constants
 MODEL_NAME = "gemini-2.0-flash"
 TOKEN_SAFETY_BUFFER = 200 # Buffer for variations and safety
 BASE_TOKEN_BUDGET_PER_DOC = 5000
@@ -70,14 +80,21 @@ FORMAT_INSTRUCTIONS = {
     "currency": "A currency value including the amount and currency code (e.g., 500 SEK, 30 USD). For example: 125.99 USD"
 }
 
-def _call_llm(prompt_formatted: str) -> str:
+def _call_llm(prompt_formatted: str, deadline: Optional[Deadline] = None) -> str:
     logger.debug(f"Sending prompt to LLM (first 200 chars): {prompt_formatted[:200]}...")
-    response = client.models.generate_content(
-        model=MODEL_NAME, contents=prompt_formatted
+    response = call_with_deadline(
+        "generate", get_client().models.generate_content,
+        deadline=deadline, model=MODEL_NAME, contents=prompt_formatted
     )
     return response.text.strip() if response.text else ""
 
-def get_answer(prompt: str, context: str, format: Union[str, AnswerFormat], n_documents: int = 1, retries: int = 1) -> str:
+def _count_tokens(contents: str, deadline: Optional[Deadline] = None) -> int:
+    return call_with_deadline(
+        "count_tokens", get_client().models.count_tokens,
+        deadline=deadline, model=MODEL_NAME, contents=contents
+    ).total_tokens
+
+def get_answer(prompt: str, context: str, format: Union[str, AnswerFormat], n_documents: int = 1, retries: int = 1, deadline: Optional[Deadline] = None) -> str:
     logger.info(f"Getting answer for prompt: '{prompt[:50]}...' with format: {format}, n_docs: {n_documents}")
 
     format_key = format.value if isinstance(format, AnswerFormat) else format
@@ -101,10 +118,7 @@ def get_answer(prompt: str, context: str, format: Union[str, AnswerFormat], n_do
 
         # get tokens for prompt structure (without actual context)
         prompt_structure_template = PROMPT.format(context="{CONTEXT_PLACEHOLDER}", question=prompt, format_instruction=current_format_instruction)
-        tokens_for_prompt_structure = client.models.count_tokens(
-            model=MODEL_NAME, 
-            contents=prompt_structure_template.replace("{CONTEXT_PLACEHOLDER}", "")
-        ).total_tokens
+        tokens_for_prompt_structure = _count_tokens(prompt_structure_template.replace("{CONTEXT_PLACEHOLDER}", ""), deadline)
 
         max_tokens_for_context = current_input_token_budget - tokens_for_prompt_structure - TOKEN_SAFETY_BUFFER
         logger.info(f"Tokens for prompt structure: {tokens_for_prompt_structure}. Max tokens available for context: {max_tokens_for_context}")
@@ -115,7 +129,7 @@ def get_answer(prompt: str, context: str, format: Union[str, AnswerFormat], n_do
             logger.error("Prompt structure and safety buffer exceed total token budget, even with no context. Using empty context.")
             context_formatted_for_llm = ""
         else:
-            current_context_tokens = client.models.count_tokens(model=MODEL_NAME, contents=context_formatted_for_llm).total_tokens
+            current_context_tokens = _count_tokens(context_formatted_for_llm, deadline)
             
             if current_context_tokens > max_tokens_for_context:
                 logger.warning(f"Context ({current_context_tokens} tokens) exceeds max allowed for context ({max_tokens_for_context} tokens). Performing token-based truncation.")
@@ -125,14 +139,14 @@ def get_answer(prompt: str, context: str, format: Union[str, AnswerFormat], n_do
                     context_formatted_for_llm = context_formatted_for_llm[:-chars_to_cut]
                     if not context_formatted_for_llm: 
                         break
-                    current_context_tokens = client.models.count_tokens(model=MODEL_NAME, contents=context_formatted_for_llm).total_tokens
+                    current_context_tokens = _count_tokens(context_formatted_for_llm, deadline)
                 logger.info(f"Context truncated to {current_context_tokens} tokens and {len(context_formatted_for_llm)} chars.")
             else:
                 logger.info(f"Context ({current_context_tokens} tokens) fits within max allowed for context ({max_tokens_for_context} tokens).")
 
         current_prompt_to_llm = PROMPT.format(context=context_formatted_for_llm, question=prompt, format_instruction=current_format_instruction)
         
-        llm_response_text = _call_llm(current_prompt_to_llm)
+        llm_response_text = _call_llm(current_prompt_to_llm, deadline)
         logger.info(f"LLM Response (attempt {attempt + 1}): {llm_response_text}")
 
         validator_model = PYDANTIC_MODELS.get(format_key)
@@ -0,0 +1,84 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+class InMemoryIndex:
+    """
+    In-process stand-in for a Pinecone index, covering the subset of the API
+    used here: namespaced upsert, fetch, delete and cosine-similarity query with
+    `$in` / equality metadata filters. Select it with VECTOR_INDEX=memory.
+    """
+
+    def __init__(self):
+        self._namespaces: Dict[str, Dict[str, Tuple[np.ndarray, dict]]] = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors: List[dict], namespace: str = "") -> dict:
+        with self._lock:
+            store = self._namespaces.setdefault(namespace, {})
+            for v in vectors:
+                values = np.asarray(v["values"], dtype=np.float32)
+                store[v["id"]] = (values / (np.linalg.norm(values) or 1.0), v.get("metadata") or {})
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids: Optional[List[str]] = None, namespace: str = "", delete_all: bool = False) -> dict:
+        with self._lock:
+            if delete_all:
+                self._namespaces.pop(namespace, None)
+            else:
+                store = self._namespaces.get(namespace, {})
+                for vector_id in ids or []:
+                    store.pop(vector_id, None)
+        return {}
+
+    def fetch(self, ids: List[str], namespace: str = "") -> dict:
+        with self._lock:
+            store = self._namespaces.get(namespace, {})
+            vectors = {
+                vector_id: {"id": vector_id, "values": store[vector_id][0].tolist(), "metadata": store[vector_id][1]}
+                for vector_id in ids if vector_id in store
+            }
+        return {"vectors": vectors, "namespace": namespace}
+
+    @staticmethod
+    def _matches_filter(metadata: dict, filter: Optional[dict]) -> bool:
+        for field, condition in (filter or {}).items():
+            value = metadata.get(field)
+            if isinstance(condition, dict) and "$in" in condition:
+                if value not in condition["$in"]:
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def query(
+        self,
+        vector: List[float],
+        top_k: int = 10,
+        include_metadata: bool = False,
+        filter: Optional[dict] = None,
+        namespace: str = "",
+        **kwargs,
+    ) -> dict:
+        with self._lock:
+            items = [
+                (vector_id, values, metadata)
+                for vector_id, (values, metadata) in self._namespaces.get(namespace, {}).items()
+                if self._matches_filter(metadata, filter)
+            ]
+        if not items:
+            return {"matches": [], "namespace": namespace}
+
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = np.stack([values for _, values, _ in items]) @ query
+        order = np.argsort(-scores)[:top_k]
+        matches = [
+            {
+                "id": items[i][0],
+                "score": float(scores[i]),
+                "metadata": items[i][2] if include_metadata else None,
+            }
+            for i in order
+        ]
+        return {"matches": matches, "namespace": namespace}
@@ -1,79 +1,161 @@
-from typing import List
+from typing import List, NamedTuple, Optional
 from uuid import UUID
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import inspect
 from dotenv import load_dotenv
 import os
-from pinecone import Pinecone
-from pydantic import BaseModel
+import numpy as np
 import logging
+from utils.deadline import Deadline, call_with_deadline, CALL_TIMEOUTS
+from utils.profiling import run_profiled
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-index = pc.Index(os.getenv("PINECONE_INDEX_NAME"))
+# "shared": all vectors in the default namespace, queries filter on document_id
+# "document": one namespace per document, queries fan out to the row's namespaces
+PINECONE_NAMESPACE_MODE = os.getenv("PINECONE_NAMESPACE_MODE", "shared")
+QUERY_FANOUT_WORKERS = 8
+# Number of chunks kept by the rerank step
+RERANK_TOP_N = 15
 
-class PineconeMetadata(BaseModel):
-    document_id: str
-    chunk_id: str
+_fanout_executor = ThreadPoolExecutor(max_workers=QUERY_FANOUT_WORKERS, thread_name_prefix="pinecone-fanout")
 
-class PineconeDocument(BaseModel):
-    id: str
-    embedding: List[float]
-    metadata: PineconeMetadata
+@lru_cache(maxsize=None)
+def get_pinecone():
+    """
+    Lazily create the Pinecone client, so importing this module (and forking
+    workers) does not pay for the client setup.
+    """
+    from pinecone import Pinecone
+    # native default request timeout, so calls abandoned by call_with_deadline still end;
+    # only clients that declare the argument honour it
+    options = {}
+    if "timeout" in inspect.signature(Pinecone).parameters:
+        options["timeout"] = max(CALL_TIMEOUTS["query"], CALL_TIMEOUTS["rerank"])
+    return Pinecone(api_key=os.getenv("PINECONE_API_KEY"), **options)
 
-def create_pinecone_documents(chunks: List[str], embeddings: List[List[float]], document_id: UUID) -> List[PineconeDocument]:
+@lru_cache(maxsize=None)
+def _timeout_kwarg(cls: type, method_name: str) -> Optional[str]:
     """
-    Creates a list of PineconeDocument objects from chunks, embeddings, and a file reference.
+    Name of the per-request timeout argument of a Pinecone SDK method: `timeout`
+    on current clients, `_request_timeout` on the OpenAPI-generated ones, which
+    pass it through **kwargs, or None when the method takes neither. The method
+    is looked up on the class, as instances may wrap it in a (*args, **kwargs) shim.
     """
-    documents = []
-    for i, (chunk_text, embedding) in enumerate(zip(chunks, embeddings)):
-        chunk_id = f"{document_id}-chunk-{i}"
-        metadata = PineconeMetadata(
-            document_id=document_id,
-            chunk_id=chunk_id
-        )
-        documents.append(PineconeDocument(id=chunk_id, embedding=embedding, metadata=metadata))
-    logger.info(f"Created {len(documents)} Pinecone documents for document_id: {document_id}")
-    return documents
+    parameters = inspect.signature(getattr(cls, method_name)).parameters
+    if "timeout" in parameters:
+        return "timeout"
+    if "_request_timeout" in parameters or any(p.kind == p.VAR_KEYWORD for p in parameters.values()):
+        return "_request_timeout"
+    return None
+
+@lru_cache(maxsize=None)
+def get_index():
+    """
+    Lazily create the Pinecone index handle, or the in-process stand-in when
+    VECTOR_INDEX=memory.
+    """
+    if os.getenv("VECTOR_INDEX") == "memory":
+        from utils.memory_index import InMemoryIndex
+        return InMemoryIndex()
+    return get_pinecone().Index(os.getenv("PINECONE_INDEX_NAME"))
+
+def namespace_for(document_id, mode: Optional[str] = None) -> str:
+    """Namespace that holds the vectors of a document in `mode` (PINECONE_NAMESPACE_MODE by default)."""
+    return str(document_id) if (mode or PINECONE_NAMESPACE_MODE) == "document" else ""
+
+class PineconeDocuments(NamedTuple):
+    """
+    Vectors of one document ready for upsert: ids and a (n, dim) float32 array
+    with the embeddings in the same order.
+    """
+    ids: List[str]
+    embeddings: np.ndarray
+    document_id: str
+
+def create_pinecone_documents(chunk_ids: List[str], embeddings: np.ndarray, document_id: UUID) -> PineconeDocuments:
+    """
+    Creates a PineconeDocuments batch from chunk ids, embeddings, and a document id.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(chunk_ids) != len(embeddings):
+        raise ValueError(f"Got {len(chunk_ids)} chunk ids but {len(embeddings)} embeddings")
+    logger.info(f"Created {len(chunk_ids)} Pinecone documents for document_id: {document_id}")
+    return PineconeDocuments(ids=list(chunk_ids), embeddings=embeddings, document_id=str(document_id))
 
 def upsert_documents(
-    documents: List[PineconeDocument],
+    documents: PineconeDocuments,
     batch_size: int = 100
 ) -> None:
     """
-    Upsert a list of PineconeDocument into the Pinecone index
-    in batches of `batch_size`.
+    Upsert PineconeDocuments into the Pinecone index in batches of `batch_size`.
+    Only the current batch is converted to the lists the client expects.
     """
     try:
-        # prepare the raw list of dicts
-        to_upsert = [
-            {
-                "id": doc.id,
-                "values": doc.embedding,
-                "metadata": doc.metadata.model_dump()
-            }
-            for doc in documents
-        ]
-
-        # slice into batches and send
-        for i in range(0, len(to_upsert), batch_size):
-            batch = to_upsert[i : i + batch_size]
-            index.upsert(vectors=batch)
+        n_vectors = len(documents.ids)
+        for i in range(0, n_vectors, batch_size):
+            batch_ids = documents.ids[i : i + batch_size]
+            batch_values = documents.embeddings[i : i + batch_size].tolist()
+            batch = [
+                {
+                    "id": chunk_id,
+                    "values": values,
+                    "metadata": {"document_id": documents.document_id, "chunk_id": chunk_id}
+                }
+                for chunk_id, values in zip(batch_ids, batch_values)
+            ]
+            get_index().upsert(vectors=batch, namespace=namespace_for(documents.document_id))
 
-            logger.info(f"✅ Upserted {len(documents)} vectors in {((len(documents)-1)//batch_size)+1} batches")
+        logger.info(f"✅ Upserted {n_vectors} vectors in {((n_vectors-1)//batch_size)+1} batches")
     except Exception as e:
         logger.error(f"Error upserting documents: {e}")
         raise e
 
-def query_pinecone(query_embedding: List[float], allowed_docs: List[str], top_k: int = 50):
+def delete_vectors(vector_ids: List[str], document_id: UUID, batch_size: int = 1000, namespace: Optional[str] = None) -> None:
+    """
+    Delete vectors of a document by id from the Pinecone index in batches of `batch_size`,
+    from the document's namespace unless `namespace` is given.
+    """
+    if namespace is None:
+        namespace = namespace_for(document_id)
+    for i in range(0, len(vector_ids), batch_size):
+        get_index().delete(ids=vector_ids[i : i + batch_size], namespace=namespace)
+    logger.info(f"Deleted {len(vector_ids)} vectors")
+
+def fetch_vectors(vector_ids: List[str], document_id: UUID, batch_size: int = 100) -> dict:
+    """
+    Fetch stored vectors of a document by id. Returns a mapping from id to a
+    float32 array; ids that are not found are left out.
+    """
+    namespace = namespace_for(document_id)
+    vectors = {}
+    for i in range(0, len(vector_ids), batch_size):
+        response = get_index().fetch(ids=vector_ids[i : i + batch_size], namespace=namespace)
+        found = response["vectors"] if isinstance(response, dict) else response.vectors
+        for vector_id, vector in found.items():
+            values = vector["values"] if isinstance(vector, dict) else vector.values
+            vectors[vector_id] = np.asarray(values, dtype=np.float32)
+    return vectors
+
+def query_pinecone(query_embedding: List[float], allowed_docs: List[str], top_k: int = 50, deadline: Optional[Deadline] = None):
 
     logger.info(f"Querying Pinecone with allowed_docs: {allowed_docs}, top_k: {top_k}")
     
     # Ensure all allowed_docs are strings
     processed_allowed_docs = [str(doc_id) for doc_id in allowed_docs]
 
-    response = index.query(
+    if PINECONE_NAMESPACE_MODE == "document":
+        return _query_namespaces(query_embedding, processed_allowed_docs, top_k, deadline)
+
+    response = call_with_deadline(
+        "query",
+        get_index().query,
+        deadline=deadline,
+        timeout_kwarg=_timeout_kwarg(type(get_index()), "query"),
         vector=query_embedding,
         top_k=top_k,
         include_metadata=True,
@@ -85,13 +167,47 @@ def query_pinecone(query_embedding: List[float], allowed_docs: List[str], top_k:
     )
     return response
 
-def rerank_pinecone_results(prompt: str, documents: List[str]):
+def _query_namespaces(query_embedding: List[float], document_ids: List[str], top_k: int, deadline: Optional[Deadline] = None) -> dict:
+    """
+    Query the namespace of every document concurrently and merge the top_k lists by score.
+    """
+    index = get_index()
+
+    def query_namespace(document_id: str):
+        response = call_with_deadline(
+            "query",
+            index.query,
+            deadline=deadline,
+            timeout_kwarg=_timeout_kwarg(type(index), "query"),
+            vector=query_embedding,
+            top_k=top_k,
+            include_metadata=True,
+            namespace=namespace_for(document_id)
+        )
+        return [
+            {"id": m["id"], "score": m["score"], "metadata": m["metadata"]}
+            for m in response.get("matches", [])
+        ]
+
+    futures = [
+        _fanout_executor.submit(contextvars.copy_context().run, run_profiled, query_namespace, document_id)
+        for document_id in document_ids
+    ]
+    matches = [m for future in futures for m in future.result()]
+    matches.sort(key=lambda m: m["score"], reverse=True)
+    return {"matches": matches[:top_k]}
+
+def rerank_pinecone_results(prompt: str, documents: List[str], deadline: Optional[Deadline] = None):
     logger.info(f"Reranking Pinecone results")
-    rerank_result = pc.inference.rerank(
+    rerank_result = call_with_deadline(
+                    "rerank",
+                    get_pinecone().inference.rerank,
+                    deadline=deadline,
+                    timeout_kwarg=_timeout_kwarg(type(get_pinecone().inference), "rerank"),
                     model="pinecone-rerank-v0", 
                     query=prompt,
                     documents=documents,
-                    top_n=min(len(documents), 15),
+                    top_n=min(len(documents), RERANK_TOP_N),
                     return_documents=True,
                     parameters={
                         "truncate": "END"  # Truncate at token limit if needed
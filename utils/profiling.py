@@ -0,0 +1,189 @@
+import asyncio
+import contextvars
+import cProfile
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Directory the profiles are written to
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Request header that switches profiling on for a single request
+PROFILE_HEADER = b"x-profile"
+# Interval (seconds) of the wall-clock stack sampler
+PROFILE_SAMPLE_INTERVAL_S = 0.005
+
+# Admin toggle: profile every request, or a random fraction of them
+profiling_settings = {
+    "enabled": False,
+    "sample_rate": float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+}
+
+_active_profile: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar("active_profile", default=None)
+# only one request is profiled at a time, so concurrent requests don't fight over the profiler
+_profile_lock = threading.Lock()
+_thread_state = threading.local()
+
+class RequestProfile:
+    """
+    Profiles the work a request runs in worker threads: a CPU profile from a
+    single cProfile profiler, enabled in one of those threads at a time, and a
+    wall-clock profile from a sampler that records the stacks of all of them,
+    including time spent waiting on I/O. The sampler leaves out the event loop
+    thread, since it also runs other requests.
+
+    Before Python 3.12 the CPU profile only covers the thread the profiler is
+    enabled in. From 3.12 cProfile is built on sys.monitoring, which is
+    interpreter-wide: while enabled, it records every thread, including the
+    event loop and other requests, so the CPU profile is process-wide there.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._profiler = cProfile.Profile(time.thread_time)
+        self._profiler_lock = threading.Lock()
+        self._cpu_profiled = False
+        self._threads = set()
+        self._stacks = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL_S):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self._threads)
+            for ident in threads:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    self._stacks[";".join(reversed(stack))] += 1
+
+    def _enable_profiler(self) -> bool:
+        if not self._profiler_lock.acquire(blocking=False):
+            return False
+        try:
+            self._profiler.enable()
+        except (ValueError, RuntimeError) as e:
+            # another profiling tool is active; profiling must never fail the request
+            logger.warning(f"Could not enable the CPU profiler: {e}")
+            self._profiler_lock.release()
+            return False
+        self._cpu_profiled = True
+        return True
+
+    def run_in_thread(self, fn: Callable, args, kwargs) -> Any:
+        if getattr(_thread_state, "profiling", False):
+            return fn(*args, **kwargs)
+        _thread_state.profiling = True
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads.add(ident)
+        cpu_profiling = self._enable_profiler()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if cpu_profiling:
+                self._profiler.disable()
+                self._profiler_lock.release()
+            with self._lock:
+                self._threads.discard(ident)
+            _thread_state.profiling = False
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        wall_time = time.perf_counter() - self._started
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        # the random suffix keeps profiles of requests to the same path in the same second apart
+        base = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.name}-{uuid.uuid4().hex[:8]}")
+        if self._cpu_profiled:
+            pstats.Stats(self._profiler).dump_stats(f"{base}.cpu.prof")
+        # collapsed stacks, one "frame;frame;frame count" line per stack (flamegraph input)
+        with open(f"{base}.wall.txt", "w") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Wrote profile {base} ({wall_time:.3f}s wall)")
+
+def run_profiled(fn: Callable, *args, **kwargs) -> Any:
+    """
+    Run `fn` in the current (worker) thread, adding it to the request profile
+    when one is active in the current context.
+    """
+    profile = _active_profile.get()
+    if profile is None:
+        return fn(*args, **kwargs)
+    return profile.run_in_thread(fn, args, kwargs)
+
+async def to_thread(fn: Callable, *args, **kwargs) -> Any:
+    """asyncio.to_thread that keeps profiling the request inside the thread."""
+    return await asyncio.to_thread(run_profiled, fn, *args, **kwargs)
+
+def iterate_profiled(iterable: Iterable) -> Iterator:
+    """
+    Wrap a synchronous iterator so every step runs through run_profiled, for
+    streaming response bodies that the server advances in worker threads.
+    """
+    iterator = iter(iterable)
+    done = object()
+    while True:
+        item = run_profiled(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+def _should_profile(scope: Dict) -> bool:
+    for key, value in scope.get("headers", []):
+        if key == PROFILE_HEADER:
+            return value not in (b"", b"0", b"false")
+    if profiling_settings["enabled"]:
+        return True
+    rate = profiling_settings["sample_rate"]
+    return rate > 0 and random.random() < rate
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles a request when it carries the X-Profile
+    header, when profiling is switched on, or when it is sampled.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _should_profile(scope):
+            return await self.app(scope, receive, send)
+        if not _profile_lock.acquire(blocking=False):
+            logger.info("Another request is being profiled, skipping profile")
+            return await self.app(scope, receive, send)
+
+        name = f"{scope['method']}{scope['path'].replace('/', '_')}"
+        profile = RequestProfile(name)
+        token = _active_profile.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _active_profile.reset(token)
+            try:
+                profile.stop()
+            finally:
+                _profile_lock.release()
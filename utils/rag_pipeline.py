@@ -1,29 +1,104 @@
-from typing import List
+from typing import Dict, List, Optional
 from uuid import UUID
-from utils.pinecone_util import query_pinecone, rerank_pinecone_results
-from utils.database_util import get_chunks_by_ids
+import logging
+import os
+from utils.pinecone_util import query_pinecone, rerank_pinecone_results, RERANK_TOP_N
+from utils.database_util import get_chunk_records_by_ids, get_documents_text_length, get_documents_chunk_texts, search_chunks_lexical
+from utils.llm import PROMPT, FORMAT_INSTRUCTIONS, BASE_TOKEN_BUDGET_PER_DOC, TOKEN_SAFETY_BUFFER
+from utils.deadline import Deadline
+from utils.profiling import to_thread
+from constants import FAST_PATH_CHARS_PER_TOKEN
 from sqlalchemy.orm import Session
 
-async def rag_pipeline(query: str, doc_ids: List[UUID], db: Session , embedding_model) -> str:
+logger = logging.getLogger(__name__)
 
-    query_embedding = embedding_model.get_embeddings([query], input_type="query")
+# "hybrid": fuse vector matches with full-text matches over the chunks table; "vector": vector matches only
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# Opt-in: skip the remote rerank when the vector and lexical rankings agree at the top
+HYBRID_SKIP_RERANK = os.getenv("HYBRID_SKIP_RERANK", "false").lower() == "true"
+VECTOR_TOP_K = 50
+# Each ranking only has to surface candidates for the fusion, so hybrid mode fetches fewer
+HYBRID_VECTOR_TOP_K = 20
+HYBRID_LEXICAL_TOP_K = 20
+# Reciprocal-rank fusion constant
+RRF_K = 60
+# The fused ranking is confident when this share of the top CONFIDENCE_DEPTH ids appears in both rankings
+CONFIDENCE_DEPTH = 5
+CONFIDENCE_MIN_OVERLAP = 0.6
 
-    pinecone_results = query_pinecone(query_embedding, doc_ids)
+retrieval_stats = {"queries": 0, "rerank_skipped": 0}
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K) -> Dict[str, float]:
+    """Fused score of every id, the sum of 1 / (k + rank) over the rankings it appears in."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return scores
+
+def rankings_agree(vector_ids: List[str], lexical_ids: List[str]) -> bool:
+    overlap = set(vector_ids[:CONFIDENCE_DEPTH]) & set(lexical_ids[:CONFIDENCE_DEPTH])
+    return len(overlap) >= CONFIDENCE_MIN_OVERLAP * CONFIDENCE_DEPTH
+
+def fits_token_budget(query: str, doc_ids: List[UUID], db: Session) -> bool:
+    """
+    Estimate whether the full stored text of the documents fits the context
+    budget that get_answer allows for this many documents.
+    """
+    total_chars = get_documents_text_length(db, doc_ids)
+    prompt_chars = len(PROMPT) + len(query) + max(len(v) for v in FORMAT_INSTRUCTIONS.values())
+    estimated_tokens = (total_chars + prompt_chars) // FAST_PATH_CHARS_PER_TOKEN
+    budget = BASE_TOKEN_BUDGET_PER_DOC * len(doc_ids) - TOKEN_SAFETY_BUFFER
+    logger.info(f"Row text is {total_chars} chars (~{estimated_tokens} tokens), budget {budget} tokens")
+    return estimated_tokens <= budget
+
+async def rag_pipeline(query: str, doc_ids: List[UUID], db: Session , embedding_model, deadline: Optional[Deadline] = None) -> str:
+
+    # fast path: the whole row fits the budget, so skip embed, query and rerank
+    # database and provider calls run in threads, so the event loop keeps serving other
+    # requests and the calls show up in request profiles
+    if await to_thread(fits_token_budget, query, doc_ids, db):
+        logger.info("Row fits the token budget, using all chunks without retrieval")
+        return "\n".join(await to_thread(get_documents_chunk_texts, db, doc_ids))
+
+    query_embedding = (await to_thread(embedding_model.get_embeddings, [query], input_type="query", deadline=deadline))[0]
+
+    hybrid = RETRIEVAL_MODE == "hybrid"
+    vector_top_k = HYBRID_VECTOR_TOP_K if hybrid else VECTOR_TOP_K
+    pinecone_results = await to_thread(query_pinecone, query_embedding.tolist(), doc_ids, top_k=vector_top_k, deadline=deadline)
 
-    # fetch chunk texts from database based on pinecone matches
-    matches = pinecone_results.get("matches", [])
     # sort matches by score descending
-    matches = sorted(matches, key=lambda m: m["score"], reverse=True)
-    chunk_ids = [m["metadata"]["chunk_id"] for m in matches]
-    chunk_texts = get_chunks_by_ids(db, chunk_ids)
-    response_chunks = [
-        {"chunk_id": cid, "score": m["score"], "text": chunk_texts.get(cid, "")}  
-        for m, cid in zip(matches, chunk_ids)
-    ]
-    # sort response_chunks by score descending
-    response_chunks = sorted(response_chunks, key=lambda c: c["score"], reverse=True)
-
-    rerank_result = rerank_pinecone_results(query, [c["text"] for c in response_chunks])
+    matches = sorted(pinecone_results.get("matches", []), key=lambda m: m["score"], reverse=True)
+    vector_ids = [m["metadata"]["chunk_id"] for m in matches]
+    if hybrid:
+        lexical_ids = await to_thread(search_chunks_lexical, db, query, doc_ids, HYBRID_LEXICAL_TOP_K)
+        scores = reciprocal_rank_fusion([vector_ids, lexical_ids])
+        logger.info(f"Fused {len(vector_ids)} vector and {len(lexical_ids)} lexical matches into {len(scores)} chunks")
+    else:
+        lexical_ids = []
+        scores = {m["metadata"]["chunk_id"]: m["score"] for m in matches}
+    chunk_ids = sorted(scores, key=scores.get, reverse=True)
+
+    # fetch chunk texts from database
+    chunk_records = await to_thread(get_chunk_records_by_ids, db, chunk_ids)
+    # keep only the best match of each near-duplicate cluster, so distinct evidence gets the rerank slots
+    response_chunks = []
+    seen_clusters = set()
+    for cid in chunk_ids:
+        record = chunk_records.get(cid)
+        if record is None or record["cluster"] in seen_clusters:
+            continue
+        seen_clusters.add(record["cluster"])
+        response_chunks.append({"chunk_id": cid, "score": scores[cid], "text": record["text"]})
+    logger.info(f"{len(response_chunks)} distinct chunks out of {len(chunk_ids)} matches")
+
+    retrieval_stats["queries"] += 1
+    if hybrid and HYBRID_SKIP_RERANK and rankings_agree(vector_ids, lexical_ids):
+        retrieval_stats["rerank_skipped"] += 1
+        logger.info("Vector and lexical rankings agree, skipping rerank")
+        return "\n".join(c["text"] for c in response_chunks[:RERANK_TOP_N])
+
+    rerank_result = await to_thread(rerank_pinecone_results, query, [c["text"] for c in response_chunks], deadline=deadline)
     
     if rerank_result and isinstance(rerank_result, list):
         all_texts = [doc.get("text", "") for doc in rerank_result if isinstance(doc, dict)]
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical work: while a computation for a key is in
+    flight, later callers with the same key await its result instead of
+    starting their own. Deduplication is per process (per worker).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]], timeout: Optional[float] = None) -> T:
+        """
+        Run `fn()` for `key`, or wait for the run already in flight. A caller that
+        waits gives up after `timeout` seconds with asyncio.TimeoutError, and takes
+        over the run when the caller running it is cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        expires_at = loop.time() + timeout if timeout is not None else None
+        self.calls += 1
+        coalesced = False
+        while True:
+            future = self._in_flight.get(key)
+            if future is None:
+                break
+            if not coalesced:
+                coalesced = True
+                self.coalesced += 1
+                logger.info(f"Coalesced {self.name} call for {key}")
+            try:
+                # shield, so a cancelled or timed-out follower does not cancel the shared result
+                waiter = asyncio.shield(future)
+                if expires_at is None:
+                    return await waiter
+                return await asyncio.wait_for(waiter, max(expires_at - loop.time(), 0))
+            except asyncio.CancelledError:
+                # the run was cancelled along with its caller, not this follower: run it again
+                if future.cancelled() and not asyncio.current_task().cancelling():
+                    logger.info(f"In-flight {self.name} call for {key} was cancelled, retrying")
+                    continue
+                raise
+
+        future = loop.create_future()
+        # mark the exception as retrieved when nobody else was waiting for it
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._in_flight[key] = future
+        self.executions += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight),
+        }
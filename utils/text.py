@@ -1,5 +1,6 @@
 from typing import List, Optional, Iterable, Callable, Any
 from abc import ABC, abstractmethod
+import hashlib
 import re
 import logging
 
@@ -13,6 +14,10 @@ def get_text_from_file(file_ref: str) -> str:
         # Replace multiple newlines with a single newline
         content = re.sub(r'\n+', '\n', content)
         return content
+
+def hash_text(text: str) -> str:
+    """SHA-256 hex digest of a text, used to detect changed documents and chunks."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
     
 
 def _split_text_with_regex(